@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Benchmarks the hot paths of the parse and import stages against
+synthetic WACArt exports built with read_test.mockExport, and writes the
+results to a JSON file so runs on different commits can be compared.
+Run as:
+
+  python benchmark.py [-s 10000,100000,1000000] [-o benchmark.json]
+"""
+
+import json
+import os
+import random
+import re
+import subprocess
+import tempfile
+import time
+from optparse import OptionParser
+
+import create_cspace_records
+import wacart
+from read_test import mockExport
+
+SIZES = [10000, 100000, 1000000]
+BENCHMARK_FILE = 'benchmark.json'
+
+# Calls timed for the per-function benchmarks, whatever the export size
+SAMPLE_LINES = 10000
+
+# Of those, lines checked to parse the same as reference_parse_line
+SAMPLE_CHECKED = 1000
+
+FIRST_NAMES = [u'John', u'Jane', u'J\xfcrgen', u'Fran\xe7oise', u'Ren\xe9e',
+  u'Marina', u'Pepe Calvo', u'Rita Mae', u'S\xf8ren', u'Jos\xe9']
+LAST_NAMES = [u'Doe', u'Roe', u'Becker', u'Abramovic', u'von Wiegand',
+  u"D'Andrea", u'M\xfcller', u'Nu\xf1ez', u'Ha\xefk', u'Cher']
+TITLES = [u'Untitled', u'Sans titre', u'Tom\xe9e', u'Composition no. %s',
+  u'Study for "Caf\xe9"', u'Landscape with water & sky']
+CLASSIFICATIONS = [u'Painting', u'Print', u'Sculpture', u'Photograph',
+  u'Artist Book', u'Film/Video']
+PLACES = [u'Boston', u'Antigua', u'Z\xfcrich', u'S\xe3o Paulo', u'Minneapolis']
+MEDIA = [u'oil on canvas', u'lithograph', u'bronze', u'gelatin silver print',
+  u'offset lithograph on paper']
+
+def person(rng, inverted):
+  first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+  if inverted:
+    return u'%s, %s' % (last, first)
+  return u'%s %s' % (first, last)
+
+def synthetic_fields(rng, i):
+  """One record's worth of export fields, as unicode."""
+  artists = [person(rng, True)]
+  for j in range(rng.choice([0, 0, 0, 1, 1, 2, 3])):
+    artists.append(person(rng, rng.random() < 0.5))
+  joiner = rng.choice([u'; ', u'; ', u' and '])
+  titles = [rng.choice(TITLES).replace(u'%s', unicode(i))
+    for j in range(rng.choice([1, 1, 2]))]
+  fields = {
+    'acc_no': u' %s.%s ' % (rng.randint(1940, 2011), i),
+    'object_id': unicode(i),
+    'classification': rng.choice(CLASSIFICATIONS),
+    'title': u'\x0b'.join(titles),
+    'creator_text_inverted': joiner.join(artists),
+    'born': u'/'.join([unicode(rng.randint(1850, 1980)) for a in artists]),
+    'birth_place': u'\x0b'.join([rng.choice(PLACES) for a in artists]),
+    'medium': rng.choice(MEDIA),
+    'width': u'%s in.\x1d%s cm' % (rng.randint(1, 90), rng.randint(3, 230)),
+    'height': u'%s in.\x1d%s cm' % (rng.randint(1, 90), rng.randint(3, 230)),
+    'date': unicode(rng.randint(1900, 2011)),
+    'iaia_subject': u'\x0b'.join(rng.sample([u'landscape', u'water', u'sky',
+      u'portrait', u'abstraction'], 2)) + u'\x0b',
+    'credit_line': u'Gift of the T. B. Walker Foundation',
+    }
+  if rng.random() < 0.2:
+    fields['author'] = u'; '.join([person(rng, True), person(rng, False)])
+    fields['author_birth_year'] = unicode(rng.randint(1900, 1980))
+  if rng.random() < 0.1:
+    fields['editor'] = person(rng, True)
+  if rng.random() < 0.1:
+    fields['running_time'] = u'%s minutes' % rng.randint(1, 120)
+  return fields
+
+def synthetic_line(rng, i):
+  fields = {}
+  for name, value in synthetic_fields(rng, i).items():
+    fields[name] = value.encode('mac-roman')
+  return mockExport(fields) + "\n"
+
+def write_synthetic_export(filename, count, seed=1):
+  """Writes a count-line export to filename, the same for the same
+  seed."""
+  rng = random.Random(seed)
+  output = open(filename, 'wb')
+  for i in range(count):
+    output.write(synthetic_line(rng, i))
+  output.close()
+
+def synthetic_export(count, seed=1):
+  """A list of count export lines."""
+  rng = random.Random(seed)
+  return [synthetic_line(rng, i) for i in range(count)]
+
+def reference_parse_line(line):
+  """parse_line as it was before the column plan, for comparison, with
+  parse-time sanitization done the same slow way. Its output should be
+  the same as parse_line's."""
+  line = line.decode('mac-roman')
+  line = re.sub(u'[\x00-\x08\x0c\x0e-\x1c\x1e\x1f]', u'', line)
+
+  objekt = {}
+  fields = line.split("\t")
+
+  for i in range(len(wacart.COLUMNS)):
+    if re.match(r'.*\w.*', fields[i]):
+      objekt[wacart.COLUMNS[i]['name']] = fields[i]
+      if wacart.COLUMNS[i].has_key('repeat'):
+        wacart.break_out_multiple_objects(wacart.COLUMNS[i]['name'], objekt)
+
+  for field in objekt.keys():
+    if type(objekt[field]) in (type(""), type(u'')):
+      objekt[field] = re.sub(u'[\x0b\x1d]', u' ', objekt[field])
+      objekt[field] = re.sub(r'\s*$', '', re.sub(r'^\s*', '', objekt[field]))
+  agents = wacart.break_out_agents(objekt)
+  return objekt, agents
+
+def time_calls(function, inputs):
+  """Calls function on each input; returns calls per second."""
+  start = time.time()
+  for value in inputs:
+    function(value)
+  elapsed = time.time() - start
+  return {'calls': len(inputs), 'seconds': elapsed, 'per_sec': len(inputs) / elapsed}
+
+def micro_benchmarks(lines):
+  for line in lines[:SAMPLE_CHECKED]:
+    assert reference_parse_line(line) == wacart.parse_line(line)
+
+  results = {}
+  results['parse_line_reference'] = time_calls(reference_parse_line, lines)
+  results['parse_line'] = time_calls(wacart.parse_line, lines)
+
+  parsed = [wacart.parse_line(line) for line in lines]
+  objects = [objekt for objekt, agents in parsed]
+  results['break_out_agents'] = time_calls(wacart.break_out_agents, objects)
+
+  names = []
+  for objekt in objects:
+    names += wacart.unpack_agent_names(objekt['creator_text_inverted'])
+  results['guess_name_order'] = time_calls(wacart.guess_name_order, names)
+
+  for objekt, agents in parsed:
+    objekt['agents'] = agents
+  results['xml_from'] = time_calls(create_cspace_records.xml_from, objects)
+  return results
+
+def end_to_end(filename, workers):
+  """Parses an export into JSON lines the way wacart.py does, less the
+  debug printing; returns lines per second."""
+  handle, output_name = tempfile.mkstemp()
+  os.close(handle)
+  output = wacart.JsonLinesWriter(output_name)
+  count = 0
+  start = time.time()
+  for objekt, agents in wacart.parse_file(filename, workers):
+    objekt['agents'] = agents
+    output.write(objekt)
+    wacart.find_oddities(objekt)
+    count += 1
+  output.close()
+  elapsed = time.time() - start
+  os.remove(output_name)
+  return {'lines': count, 'workers': workers, 'seconds': elapsed,
+    'per_sec': count / elapsed}
+
+def current_commit():
+  try:
+    process = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+  except OSError:
+    return None
+  if process.returncode != 0:
+    return None
+  return out.strip()
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option('-s', '--sizes', dest='sizes',
+    default=','.join([str(size) for size in SIZES]),
+    help="comma-separated export sizes, in lines [default: %default]")
+  parser.add_option('-j', '--workers', dest='workers', type='int', default=1,
+    help="processes for the end-to-end parse [default: %default]")
+  parser.add_option('-o', '--output', dest='output', default=BENCHMARK_FILE,
+    help="where to write the results [default: %default]")
+  (options, args) = parser.parse_args()
+
+  results = {
+    'commit': current_commit(),
+    'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'micro': micro_benchmarks(synthetic_export(SAMPLE_LINES)),
+    'end_to_end': {},
+    }
+  for name, result in sorted(results['micro'].items()):
+    print "%-22s %12.0f calls/sec" % (name, result['per_sec'])
+
+  for size in [int(size) for size in options.sizes.split(',')]:
+    handle, filename = tempfile.mkstemp(suffix='.tab')
+    os.close(handle)
+    try:
+      write_synthetic_export(filename, size)
+      result = end_to_end(filename, options.workers)
+    finally:
+      os.remove(filename)
+    results['end_to_end'][str(size)] = result
+    print "end to end, %8s lines: %10.0f lines/sec" % (size, result['per_sec'])
+
+  output = open(options.output, 'w')
+  json.dump(results, output, indent=2, sort_keys=True)
+  output.close()
+  print "results written to %s" % options.output
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import BaseHTTPServer
+import cgi
+import threading
+import unittest
+import urlparse
+
+import cspace_client
+import create_cspace_records
+import dates
+import list_current_cspace_objects
+import person_authority
+import time
+
+class FakeServices(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  seen = []
+
+  def do_GET(self):
+    FakeServices.seen.append((self.path, self.headers.getheader('Authorization')))
+    body = '<ok/>'
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/xml')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class TestClient(unittest.TestCase):
+
+  def setUp(self):
+    FakeServices.seen = []
+    self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeServices)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.url = 'http://127.0.0.1:%s/cspace-services/' % self.server.server_port
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testPreemptiveAuthAndReuse(self):
+    client = cspace_client.CSpaceClient(self.url, 'me', 'secret', pool_size=1)
+    for i in range(3):
+      resp, content = client.get('collectionobjects?pgNum=%s' % i)
+      self.assertEqual('200', resp['status'])
+      self.assertEqual('<ok/>', content)
+    self.assertEqual('/cspace-services/collectionobjects?pgNum=2', FakeServices.seen[2][0])
+    self.assertEqual('Basic bWU6c2VjcmV0', FakeServices.seen[0][1])
+    stats = client.stats()
+    self.assertEqual(3, stats['requests'])
+    self.assertEqual(1, stats['connections_opened'])
+    self.assertEqual(2, stats['connections_reused'])
+
+class FakeListing(object):
+  """Stands in for a client over a server holding total objects."""
+
+  def __init__(self, total):
+    self.total = total
+    self.paths = []
+
+  def get(self, path):
+    self.paths.append(path)
+    query = cgi.parse_qs(urlparse.urlsplit(path).query)
+    page, size = int(query['pgNum'][0]), int(query['pgSz'][0])
+    numbers = range(page * size, min((page + 1) * size, self.total))
+    items = ''.join(['<list-item><objectNumber>%s</objectNumber></list-item>' % n
+      for n in numbers])
+    # object 0 shows up again on the last page, as if it had moved
+    if numbers and numbers[-1] == self.total - 1:
+      items += '<list-item><objectNumber>0</objectNumber></list-item>'
+    return {'status': '200'}, ('<ns2:abstract-common-list xmlns:ns2="http://collectionspace.org/services/jaxb">'
+      '<pageNum>%s</pageNum><pageSize>%s</pageSize><itemsInPage>%s</itemsInPage>'
+      '<totalItems>%s</totalItems>%s</ns2:abstract-common-list>') % (page, size,
+      len(numbers), self.total, items)
+
+class TestListing(unittest.TestCase):
+
+  def testPagesFetchedConcurrently(self):
+    client = FakeListing(23)
+    cobjects = list_current_cspace_objects.list_objects(client, 5, workers=3)
+    self.assertEqual([str(n) for n in range(23)], cobjects)
+    self.assertEqual(5, len(client.paths))
+
+  def testSinglePage(self):
+    client = FakeListing(3)
+    self.assertEqual(['0', '1', '2'], list_current_cspace_objects.list_objects(client, 5))
+    self.assertEqual(1, len(client.paths))
+
+class FakeRecentChanges(object):
+  """Serves (objectNumber, updatedAt) pairs newest first, at most
+  max_page_size a page."""
+
+  def __init__(self, items, max_page_size=100):
+    self.items = items
+    self.max_page_size = max_page_size
+    self.pages = []
+
+  def get(self, path):
+    query = cgi.parse_qs(urlparse.urlsplit(path).query)
+    page, size = int(query['pgNum'][0]), min(int(query['pgSz'][0]), self.max_page_size)
+    self.pages.append(page)
+    items = ''.join(['<list-item><updatedAt>%s</updatedAt><objectNumber>%s</objectNumber></list-item>'
+      % (updated, number) for number, updated in self.items[page * size:(page + 1) * size]])
+    return {'status': '200'}, ('<abstract-common-list><totalItems>%s</totalItems>'
+      '%s</abstract-common-list>' % (len(self.items), items))
+
+class TestDelta(unittest.TestCase):
+
+  def testChangedSinceStopsAtMark(self):
+    client = FakeRecentChanges([('9', '2011-05-04T10:00:00Z'),
+      ('3', '2011-05-03T10:00:00Z'), ('7', '2011-05-02T10:00:00Z'),
+      ('1', '2011-05-01T10:00:00Z'), ('2', '2011-04-01T10:00:00Z')])
+    numbers, newest = list_current_cspace_objects.list_changed_since(client,
+      '2011-05-02T10:00:00Z', 2)
+    self.assertEqual(['9', '3', '7'], numbers)
+    self.assertEqual('2011-05-04T10:00:00Z', newest)
+    self.assertEqual([0, 1], client.pages)
+    self.assertEqual('2011-05-04T10:00:00Z', list_current_cspace_objects.newest_update(client))
+
+  def testChangedSincePagesPastAShortPage(self):
+    client = FakeRecentChanges([('9', '2011-05-04T10:00:00Z'),
+      ('3', '2011-05-03T10:00:00Z'), ('7', '2011-05-02T10:00:00Z'),
+      ('1', '2011-05-01T10:00:00Z'), ('2', '2011-04-01T10:00:00Z')], max_page_size=2)
+    numbers, newest = list_current_cspace_objects.list_changed_since(client,
+      '2011-01-01T10:00:00Z', 10)
+    self.assertEqual(['9', '3', '7', '1', '2'], numbers)
+    self.assertEqual([0, 1, 2], client.pages)
+
+  def testMergeAndReconcile(self):
+    cobjects = ['1', '2']
+    self.assertEqual(['3'], list_current_cspace_objects.merge_objects(cobjects, ['2', '3', '3']))
+    self.assertEqual(['1', '2', '3'], cobjects)
+    self.assertTrue(list_current_cspace_objects.reconcile_due({}))
+    state = {'updated_at': '2011-05-04T10:00:00Z', 'full_listing_at': 1000}
+    self.assertFalse(list_current_cspace_objects.reconcile_due(state, 2000))
+    self.assertTrue(list_current_cspace_objects.reconcile_due(state, 1000 + 8 * 86400))
+
+class FakeAuthority(object):
+  """A person authority holding terms, one by default, that can have more
+  created. Sends at most max_page_size terms a page, whatever's asked
+  for. Creating anyone named in refuse fails."""
+
+  def __init__(self, names=['Jonas  Mekas'], max_page_size=100, refuse=[]):
+    self.names = names
+    self.max_page_size = max_page_size
+    self.refuse = refuse
+    self.posts = []
+
+  def get(self, path):
+    if path.startswith('personauthorities/auth/items?'):
+      query = dict([part.split('=') for part in path.split('?')[1].split('&')])
+      size = min(int(query['pgSz']), self.max_page_size)
+      start = int(query['pgNum']) * size
+      items = ''.join(['<list-item><displayName>%s</displayName>'
+        '<refName>urn:%s</refName></list-item>' % (name, name.split()[-1].lower())
+        for name in self.names[start:start + size]])
+      return {'status': '200'}, ('<abstract-common-list><totalItems>%s</totalItems>'
+        '%s</abstract-common-list>' % (len(self.names), items))
+    csid = path.split('/')[-1]
+    return {'status': '200'}, '<document><refName>urn:%s</refName></document>' % csid
+
+  def post_xml(self, path, xml):
+    time.sleep(0.05)
+    self.posts.append(xml)
+    for name in self.refuse:
+      if xml.find('<surName>%s</surName>' % name) > -1:
+        return {'status': '500'}, 'nope'
+    return {'status': '201', 'location':
+      'http://localhost/personauthorities/auth/items/new%s' % len(self.posts)}, ''
+
+class TestPersonResolver(unittest.TestCase):
+
+  def testPrefetchedAndCreatedOnce(self):
+    client = FakeAuthority()
+    resolver = person_authority.PersonResolver(client, 'auth', page_size=10)
+    self.assertEqual(1, resolver.prefetch())
+    self.assertEqual('urn:mekas', resolver.resolve({'last_name': 'Mekas', 'first_name': 'jonas'}))
+    self.assertEqual(0, len(client.posts))
+
+    doe = {'last_name': 'Doe', 'first_name': 'John'}
+    threads = [threading.Thread(target=resolver.resolve, args=(doe,)) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(1, len(client.posts))
+    self.assertTrue(client.posts[0].find('<surName>Doe</surName>') > -1)
+
+    born = {'last_name': 'Roe', 'first_name': 'Jane', 'born': u'1940'}
+    dates.normalize_dates([{'agents': [born]}])
+    person = person_authority.person_xml(born, 'auth')
+    self.assertTrue(person.find('<birthDateGroup><dateDisplayDate>1940</dateDisplayDate>'
+      '<dateEarliestSingleYear>1940</dateEarliestSingleYear>') > -1)
+
+    record = {'acc_no': '2020.142.5', 'agents': [dict(doe, agent_type='artist'),
+      {'agent_type': 'editor'}]}
+    resolver.link_agents(record)
+    self.assertEqual('urn:new1', record['agents'][0]['refName'])
+    self.assertFalse(record['agents'][1].has_key('refName'))
+    self.assertEqual({'person_hits': 2, 'persons_created': 1, 'person_failures': 0},
+      resolver.stats())
+
+    some_xml = create_cspace_records.xml_from(record)
+    self.assertTrue(some_xml.find('urn:new1</collectionobjects_common:objectProductionPerson>') > -1)
+    self.assertTrue(some_xml.find('>artist</') > -1)
+
+  def testPrefetchPagesPastAShortPage(self):
+    client = FakeAuthority(['Person %s' % i for i in range(25)], max_page_size=10)
+    resolver = person_authority.PersonResolver(client, 'auth', page_size=50)
+    self.assertEqual(25, resolver.prefetch())
+    self.assertEqual('urn:24', resolver.resolve({'first_name': 'Person', 'last_name': '24'}))
+
+  def testFailedCreateNotRetried(self):
+    client = FakeAuthority(refuse=['Doe'])
+    resolver = person_authority.PersonResolver(client, 'auth')
+    doe = {'last_name': 'Doe', 'first_name': 'John'}
+    self.assertEqual(None, resolver.resolve(doe))
+    self.assertEqual(None, resolver.resolve(doe))
+    self.assertEqual(1, len(client.posts))
+    self.assertEqual(1, resolver.stats()['person_failures'])
+
+if __name__ == "__main__":
+    unittest.main()
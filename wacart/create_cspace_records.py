@@ -6,17 +6,29 @@ Reads the pickle files of records in CSpace and of records from the
 WACArt FM export, and inserts appropriate things into CSpace.
 """
 
-import codecs
 import cPickle
-import httplib2
-import json
+import os
+import wacart
+import cspace_client
+from cspace_client import shared_client
+from dates import date_group_fields, normalize_dates
+from dimensions import normalize_dimensions
+from existence_index import ExistenceIndex, index_exists
+from journal import Journal, journaled_successes
+from person_authority import PersonResolver, display_name, name_key
+from records import compact_record
+from staging import StagingStore
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
 
 from lxml import etree 
 from lxml.builder import E
 from lxml.builder import ElementMaker
-from collections import defaultdict
+from collections import Counter, defaultdict
 from pprint import pprint
 from csconstants import *
+from metrics import Metrics
+from report import Report, IMPORT_REPORT_CATEGORIES, IMPORT_SUMMARY_FILE
 
 UNARY_OBJECT_FIELDS = [
   'running_time',
@@ -92,6 +104,25 @@ AUTHOR_FIELDS = [
 OTHER_AGENTS = [
   'editor',
   ]
+# Agent fields build_agent_index shares between records, and the author
+# fields that mean the same thing.
+AGENT_DEMOGRAPHIC_FIELDS = [
+  'born',
+  'died',
+  'nationality',
+  'birth_place',
+  'sex',
+  'ethnicity',
+  ]
+AGENT_FIELD_ALIASES = {
+  'died': 'author_death_year',
+  'nationality': 'author_nationality',
+  'birth_place': 'author_birth_place',
+  'sex': 'author_gender',
+  }
+
+# For --export: records in each imports file
+EXPORT_RECORDS_PER_FILE = 1000
 
 def value_present(record, fieldname):
   if record.has_key(fieldname) and record[fieldname] is not None and record[fieldname] != '':
@@ -100,6 +131,19 @@ def value_present(record, fieldname):
     return False
   
 def xml_from(record):
+  """A complete imports document for one record."""
+  return imports_document([record])
+
+def imports_document(records):
+  """One imports document holding all of records, with seq numbered
+  from 1 in list order."""
+  outer = E.imports()
+  for i in range(len(records)):
+    outer.append(import_element(records[i], i + 1))
+  #print etree.tostring(outer, pretty_print=True)
+  return etree.tostring(outer)
+
+def import_element(record, seq=1):
   #
   # Schema is at https://source.collectionspace.org/collection-space/src/services/tags/v1.9/services/collectionobject/jaxb/src/main/resources/collectionobjects_common.xsd
   #
@@ -128,7 +172,26 @@ def xml_from(record):
         )
       )
     cs_schema.append(title_list) 
-  if record.has_key('date'):
+  people = [agent for agent in record.get('agents', []) if agent.has_key('refName')]
+  if len(people) > 0:
+    person_list = CC('objectProductionPersonGroupList')
+    for agent in people:
+      person_list.append(
+        CC.objectProductionPersonGroup(
+          CC.objectProductionPerson(agent['refName']),
+          CC.objectProductionPersonRole(agent['agent_type'])
+        )
+      )
+    cs_schema.append(person_list)
+  # The structured fields are only here once normalize_dates has been
+  # run over the records.
+  if record.has_key('production_date'):
+    cs_schema.append(
+      CC.objectProductionDateGroup(
+        *date_group_fields(record['production_date'], CC)
+      )
+    )
+  elif record.has_key('date'):
     cs_schema.append(
       CC.objectProductionDateGroup(
         CC.dateDisplayDate(record['date'])
@@ -169,18 +232,27 @@ def xml_from(record):
   if record.has_key('inscription_location'):
     cs_schema.append(CC.inscriptionContent("\n".join(record['inscription_location'])))
 
+  # Widths, heights, depths and weights are only here once
+  # normalize_dimensions has been run over the records.
+  dimension_groups = []
   if record.has_key('running_time'):
-    cs_schema.append(
-        CC.dimensions(
-          CC.dimensionList(
-            CC.dimensionGroup(
-              CC.value(record['running_time']),
-              CC.measurementUnit('minutes'),
-              CC.dimension('running-time')
-              )
-            )
-          )
+    dimension_groups.append(
+      CC.dimensionGroup(
+        CC.value(record['running_time']),
+        CC.measurementUnit('minutes'),
+        CC.dimension('running-time')
+        )
+      )
+  for measurement in record.get('measurements', []):
+    dimension_groups.append(
+      CC.dimensionGroup(
+        CC.value('%.2f' % measurement['value']),
+        CC.measurementUnit(measurement['unit']),
+        CC.dimension(measurement['dimension'])
         )
+      )
+  if len(dimension_groups) > 0:
+    cs_schema.append(CC.dimensions(CC.dimensionList(*dimension_groups)))
 
   # There's probably a class of variables that we can easily handle with
   # just a fieldname mapping; let's set that up, and then let the
@@ -197,71 +269,69 @@ def xml_from(record):
         values += record[key]
     wac_schema.append(WAC.walkercondition("\n".join(values)))
 
-  outer = E.imports(
-    E('import',
-      cs_schema,
-      wac_schema,
-      {'seq': '1', 'service': 'CollectionObjects', 'type': 'CollectionObject'}
-    )
+  return E('import',
+    cs_schema,
+    wac_schema,
+    {'seq': str(seq), 'service': 'CollectionObjects', 'type': 'CollectionObject'}
   )
-  #print etree.tostring(outer, pretty_print=True)
-  return etree.tostring(outer)
 
-def insert_into_cspace(record):
-  """
-  return 1 on success, 0 on failure
-  """
+def post_imports(object_xml, metrics, count=1):
+  """POSTs an imports document, returning the httplib2 response and
+  content."""
+  print "making POST..."
+  with metrics.timer('post', count) as timer:
+    resp, content = shared_client().post_xml('imports', object_xml.encode('utf-8'))
+    if resp['status'] != '200':
+      timer.fail()
+  return resp, content
 
-  # 
-  # Can't have bare ampersands. There don't seem to be any encoded
-  # ampersands coming our way, so we just do a replace.
-  # TODO expand to handle other potentially invalid characters, such as
-  # the FileMaker repeat character that may sneak in anywhere
-  # Maybe handle this in the parsing stage?
-  #
-  for k in record.keys():
-    if type(record[k]) == type('') and record[k] is not None:
-      record[k] = record[k].replace("&", "&amp;")
-    if type(record[k]) == type([]):
-      for i in range(len(record[k])):
-        if type(record[k][i]) == type('') and record[k][i] is not None:
-          record[k][i] = record[k][i].replace("&", "&amp;")
-
-  # TODO handle creators
+# import-result states that mean the item didn't go in
+FAILED_IMPORT_STATES = ['error', 'failed', 'failure']
+
+def import_outcomes(content, count):
   """
-  Need to do this for artist, author, and editor, each of which has its
-    own fields.
-  Maybe it's time for agent to be classes? Or just a hash with type in
-    [artist|author|editor]?
-  Anyhow, for each do this:
-  - see if they're in cspace already
-  - if not, insert them
-  - save away the relevant info so we can insert them into the
-    collectionobject appropriately
+  What the import-result report in an imports response says about each
+  of count seqs: a list with None for each that went in and an error
+  message for each that didn't. A seq the report leaves out counts as
+  failed. Returns None if there's no report, leaving the HTTP status as
+  all there is to go on.
   """
-  #creators = record.findall(".//{http://www.getty.edu/CDWA/CDWALite/}indexingCreatorSet")
-  #for creator in creators:
-  #  person = {}
-  #  for field in ARTIST_FIELDS:
-  #    element = record.find(".//{http://www.getty.edu/CDWA/CDWALite/}%s" % field)
-  #    if element is not None:
-  #      person[field] = (element.text)
-  #  creator_values.append(person)
-
+  try:
+    root = etree.fromstring(content, etree.XMLParser(recover=True))
+  except (etree.XMLSyntaxError, ValueError):
+    return None
+  if root is None:
+    return None
+  results = [element for element in root.iter()
+    if isinstance(element.tag, basestring) and etree.QName(element).localname == 'import-result']
+  if len(results) == 0:
+    return None
 
-  object_xml = xml_from(record)
-
-  h = httplib2.Http()
-  h.add_credentials(CSPACE_USER, CSPACE_PASS)
-  print "making POST..."
-  resp, content = h.request(
-    CSPACE_URL + 'imports',
-    'POST',
-    body = object_xml.encode('utf-8'),
-    headers = {'Content-Type': 'application/xml'}
-    )
+  outcomes = ['not in the import-result report'] * count
+  for result in results:
+    seq = result.get('seq') or result.findtext('seq')
+    try:
+      i = int(seq) - 1
+    except (TypeError, ValueError):
+      continue
+    if i < 0 or i >= count:
+      continue
+    state = result.get('state') or result.findtext('state') or \
+      result.get('status') or result.findtext('status') or ''
+    error = result.get('error') or result.findtext('error')
+    if error:
+      outcomes[i] = error.strip()
+    elif state.strip().lower() in FAILED_IMPORT_STATES:
+      outcomes[i] = state.strip()
+    else:
+      outcomes[i] = None
+  return outcomes
 
-  if resp['status'] == '200':
+def report_insert(record, resp, content, error=None):
+  """Prints the outcome of inserting one record. Returns 1 on success,
+  0 on failure. error is what the import-result report said was wrong
+  with this record, if anything."""
+  if resp['status'] == '200' and error is None:
     if record['title'] is None:
       print "Inserted '%s' into collectionspace\n" % record['acc_no'].encode('utf-8')
     else:
@@ -275,56 +345,338 @@ def insert_into_cspace(record):
       ovd[key] = record[key]
     pprint(ovd)
     print "Response: %s" % resp
+    if error is not None:
+      print "Error: %s" % error.encode('utf-8')
     print "Content: %s\n" % content
     return 0
 
+def report_inserts(records, resp, content):
+  """report_insert for each record in a document that got resp, going by
+  the import-result report when there is one."""
+  outcomes = None
+  if resp['status'] == '200':
+    outcomes = import_outcomes(content, len(records))
+  if outcomes is None:
+    outcomes = [None] * len(records)
+  return [report_insert(records[i], resp, content, outcomes[i])
+    for i in range(len(records))]
+
+def insert_into_cspace(record, metrics=None):
+  """
+  return 1 on success, 0 on failure. Serialize and POST times are
+  recorded against metrics, if given.
+  """
+  if metrics is None:
+    metrics = Metrics('insert_into_cspace')
+
+  # Artists, authors and editors are linked to person authority terms
+  # by a PersonResolver before records get here; see insert_records.
+
+  with metrics.timer('serialize'):
+    object_xml = xml_from(record)
+
+  resp, content = post_imports(object_xml, metrics)
+  return report_inserts([record], resp, content)[0]
+
+def insert_batch_into_cspace(records, metrics=None):
+  """
+  Inserts records with as few imports POSTs as possible. Returns a list
+  with 1 (success) or 0 (failure) for each record, in order.
+  """
+  if metrics is None:
+    metrics = Metrics('insert_batch_into_cspace')
+  return post_batch(records, metrics)
+
+def post_batch(records, metrics, object_xml=None):
+  """
+  A 200 means the document was taken, and its import-result report says
+  how each seq went; anything else means none of it went in. A document
+  that fails as a whole is split in half and each half retried, until
+  the bad records are isolated and fail on their own. object_xml, if
+  given, is the records' imports document, already serialized.
+  """
+  if object_xml is None:
+    with metrics.timer('serialize', len(records)):
+      object_xml = imports_document(records)
+
+  resp, content = post_imports(object_xml, metrics, len(records))
+  if resp['status'] == '200' or len(records) == 1:
+    return report_inserts(records, resp, content)
+
+  print "Batch of %s records failed, splitting it." % len(records)
+  metrics.count('batch_splits')
+  half = len(records) / 2
+  return post_batch(records[:half], metrics) + post_batch(records[half:], metrics)
+
+def export_imports(records, prefix, records_per_file=EXPORT_RECORDS_PER_FILE,
+                   metrics=None):
+  """
+  Writes records to imports documents named prefix-0001.xml,
+  prefix-0002.xml, ..., records_per_file to a file, with seq numbered
+  from 1 in each. Each file is streamed out a record at a time, and is
+  byte for byte what insert_batch_into_cspace would POST for the same
+  records. Returns the names of the files written.
+  """
+  if metrics is None:
+    metrics = Metrics('export_imports')
+  filenames = []
+  iterator = iter(records)
+  record = next(iterator, None)
+  while record is not None:
+    filename = '%s-%04d.xml' % (prefix, len(filenames) + 1)
+    output = open(filename, 'wb')
+    with etree.xmlfile(output, encoding='ascii') as xf:
+      with xf.element('imports'):
+        seq = 0
+        while record is not None and seq < records_per_file:
+          seq += 1
+          with metrics.timer('serialize'):
+            xf.write(import_element(record, seq))
+          metrics.advance()
+          record = next(iterator, None)
+    output.close()
+    print "wrote %s records to %s" % (seq, filename)
+    filenames.append(filename)
+  return filenames
+
+def batches(records, size):
+  """Yields successive slices of records at most size long."""
+  for i in range(0, len(records), size):
+    yield records[i:i + size]
+
+def insert_records(records, metrics, batch_size=1, workers=1, on_result=None,
+                   resolver=None):
+  """
+  Inserts records, batch_size to a POST, with up to workers POSTs in
+  flight at once. Returns the number created once every record has been
+  tried.
+  If given, on_result(record, result) is called as each record's 1 or 0
+  comes back, possibly from several threads at once, and resolver links
+  each record's agents to person authority terms first.
+  """
+  if batch_size > 1:
+    work = list(batches(records, batch_size))
+  else:
+    work = [[record] for record in records]
+
+  def insert(batch):
+    if resolver is not None:
+      with metrics.timer('resolve_agents', len(batch)):
+        for record in batch:
+          resolver.link_agents(record)
+    if len(batch) > 1:
+      results = insert_batch_into_cspace(batch, metrics)
+    else:
+      results = [insert_into_cspace(batch[0], metrics)]
+    if on_result is not None:
+      for record, result in zip(batch, results):
+        on_result(record, result)
+    metrics.advance(len(batch))
+    return sum(results)
+
+  if workers <= 1:
+    return sum([insert(batch) for batch in work])
+
+  pool = ThreadPool(workers)
+  try:
+    return sum(pool.imap_unordered(insert, work))
+  finally:
+    pool.close()
+    pool.join()
+
 def load_cspace_objectids():
+  """
+  The object numbers already in CollectionSpace, as something that
+  supports in and add: the existence index if there is one, otherwise a
+  set made from the older pickled list.
+  """
+  if index_exists(CS_INDEX_FILE):
+    return ExistenceIndex(CS_INDEX_FILE)
   pickle_file = open(CS_OBJECT_FILE, 'rb')
   cobjects = cPickle.load(pickle_file)
   pickle_file.close()
-  return cobjects
+  return set(cobjects)
 
 def load_wacart_objects():
-  jfile = codecs.open(WAC_OBJECTS_FILE, 'r', 'utf-8')
-  cobjects = json.load(jfile)
-  jfile.close()
-  return cobjects
+  shared = {}
+  return [compact_record(r, shared) for r in wacart.read_objects(WAC_OBJECTS_FILE)]
+
+def load_staged_objects(store, classification=None, acc_no_prefix=None):
+  shared = {}
+  return [compact_record(r, shared) for r in store.select(classification, acc_no_prefix)]
 
 def prune_existing_records(objects, existing_objectids):
   return [obj for obj in objects if not obj['acc_no'] in existing_objectids]
 
-def split_records_by_artist_count(records):
-  """When there are multiple artists associated with a record, those
+def agent_demographics(agent):
+  """The demographic fields of an agent, under their artist names."""
+  demographics = {}
+  for field in AGENT_DEMOGRAPHIC_FIELDS:
+    value = agent.get(field)
+    if not value and AGENT_FIELD_ALIASES.has_key(field):
+      value = agent.get(AGENT_FIELD_ALIASES[field])
+    if value:
+      demographics[field] = value
+  return demographics
+
+def build_agent_index(records):
+  """
+  When there are multiple artists associated with a record, those
   other than the first one or two tend to not have any demographic info.
-  Since those artists may appear elsewhere in the collection with said
-  demographic info, we handle all the single artist records first.
+  Those artists may appear elsewhere in the collection with said
+  demographic info, so this goes over every record once and returns a
+  dict of normalized name -> the demographics seen most often for that
+  name, field by field.
   """
-  single_artist_records = []
-  multi_artist_records = []
+  votes = defaultdict(lambda: defaultdict(Counter))
   for record in records:
-    if record.has_key('artists') and len(record['artists']) > 1:
-      multi_artist_records.append(record)
-    else:
-      single_artist_records.append(record)
-  return (single_artist_records, multi_artist_records)
+    for agent in record.get('agents', []):
+      name = display_name(agent)
+      if name == u'':
+        continue
+      for field, value in agent_demographics(agent).items():
+        votes[name_key(name)][field][value] += 1
+
+  index = {}
+  for key, fields in votes.items():
+    index[key] = {}
+    for field, counts in fields.items():
+      index[key][field] = counts.most_common(1)[0][0]
+  return index
+
+def enrich_agents(records, agent_index):
+  """Fills in demographic fields each agent lacks from agent_index.
+  Returns the number of fields filled."""
+  filled = 0
+  for record in records:
+    for agent in record.get('agents', []):
+      known = agent_index.get(name_key(display_name(agent)), {})
+      have = agent_demographics(agent)
+      for field, value in known.items():
+        if not have.has_key(field):
+          agent[field] = value
+          filled += 1
+  return filled
 
 if __name__ == "__main__":
-  existing_cspace_records = load_cspace_objectids()
-  print "existing records loaded"
-  wacart_records = load_wacart_objects()
-  print "records to insert loaded"
-  records_to_create = prune_existing_records(wacart_records, existing_cspace_records)
+  parser = OptionParser()
+  parser.add_option('-b', '--batch-size', dest='batch_size', type='int',
+    default=1, help="records per imports POST [default: %default]")
+  parser.add_option('-w', '--workers', dest='workers', type='int',
+    default=1, help="imports POSTs in flight at once [default: %default]")
+  parser.add_option('-s', '--staging', dest='staging', action='store_true',
+    default=False, help="read records from the staging store in %s rather "
+      "than %s, and record each one's import status there" %
+      (WAC_STAGING_FILE, WAC_OBJECTS_FILE))
+  parser.add_option('--classification', dest='classification',
+    help="with --staging, only import records with this classification")
+  parser.add_option('--acc-no-prefix', dest='acc_no_prefix',
+    help="with --staging, only import records whose acc_no starts with this")
+  parser.add_option('-x', '--export', dest='export', metavar='PREFIX',
+    help="write imports files named PREFIX-0001.xml etc. instead of "
+      "POSTing to CollectionSpace")
+  parser.add_option('--records-per-file', dest='records_per_file', type='int',
+    default=EXPORT_RECORDS_PER_FILE,
+    help="with --export, records in each file [default: %default]")
+  parser.add_option('-a', '--link-agents', dest='link_agents',
+    action='store_true', default=False,
+    help="find or create a person authority term for each agent and link "
+      "it to the object (needs PERSON_AUTHORITY_CSID)")
+  parser.add_option('-r', '--resume', dest='resume', action='store_true',
+    default=False, help="skip records %s says were already created, and "
+      "append to it rather than starting it over" % IMPORT_JOURNAL_FILE)
+  (options, args) = parser.parse_args()
+
+  if options.workers > CSPACE_POOL_SIZE:
+    cspace_client.set_shared_client(
+      cspace_client.CSpaceClient(pool_size=options.workers))
+
+  metrics = Metrics('create_cspace_records')
+  with metrics.timer('load'):
+    if options.resume and not index_exists(CS_INDEX_FILE) and not os.path.exists(CS_OBJECT_FILE):
+      existing_cspace_records = set()
+    else:
+      existing_cspace_records = load_cspace_objectids()
+    print "existing records loaded"
+    if options.staging:
+      staging_store = StagingStore(WAC_STAGING_FILE)
+      wacart_records = load_staged_objects(staging_store,
+        options.classification, options.acc_no_prefix)
+    else:
+      staging_store = None
+      wacart_records = load_wacart_objects()
+    print "records to insert loaded"
+  with metrics.timer('prune', len(wacart_records)):
+    records_to_create = prune_existing_records(wacart_records, existing_cspace_records)
+    if options.resume:
+      records_to_create = prune_existing_records(records_to_create,
+        journaled_successes(IMPORT_JOURNAL_FILE))
   print "records pruned"
-  single_artist_records, multi_artist_records = split_records_by_artist_count(records_to_create)
-  print "records split"
+  with metrics.timer('enrich_agents', len(records_to_create)):
+    if staging_store is not None and (options.classification or options.acc_no_prefix):
+      # Agents in the selection may have their demographics elsewhere in
+      # the collection; read the whole store for them.
+      agent_index = build_agent_index(staging_store.select())
+    else:
+      agent_index = build_agent_index(wacart_records)
+    filled = enrich_agents(records_to_create, agent_index)
+  print "agent demographics filled in: %s" % filled
+  with metrics.timer('normalize_dates', len(records_to_create)):
+    yearless = normalize_dates(records_to_create)
+  metrics.count('yearless_dates', yearless)
+  print "dates without a year: %s" % yearless
+  report = Report(categories=IMPORT_REPORT_CATEGORIES,
+    summary_file=IMPORT_SUMMARY_FILE)
+  with metrics.timer('normalize_dimensions', len(records_to_create)):
+    problems = normalize_dimensions(records_to_create, report)
+  report.close()
+  metrics.count('dimension_problems', problems)
+  print "dimensions that couldn't be parsed or disagree: %s" % problems
+  metrics.total = len(records_to_create)
+
+  if options.export:
+    export_imports(records_to_create,
+      options.export, options.records_per_file, metrics)
+    print metrics.progress_line()
+    metrics.write_summary()
+    raise SystemExit
+
+  resolver = None
+  if options.link_agents:
+    if PERSON_AUTHORITY_CSID == '':
+      parser.error("--link-agents needs PERSON_AUTHORITY_CSID set in csconstants.py")
+    resolver = PersonResolver(shared_client())
+    with metrics.timer('prefetch_persons'):
+      print "%s person authority terms loaded" % resolver.prefetch()
+
+  journal = Journal(IMPORT_JOURNAL_FILE, append=options.resume)
 
-  total_records_created = 0
+  def note_result(record, result):
+    journal.note(record['acc_no'], result)
+    if result:
+      existing_cspace_records.add(record['acc_no'])
+    if staging_store is not None:
+      if result:
+        staging_store.set_status(record['acc_no'], 'created')
+      else:
+        staging_store.set_status(record['acc_no'], 'failed')
 
-  for record in single_artist_records:
-    total_records_created += insert_into_cspace(record)
-    print "now have %s single artist records" % len(single_artist_records)
-  for record in multi_artist_records:
-    total_records_created += insert_into_cspace(record)
-    print "now have %s multi artist records" % len(multi_artist_records)
+  # Agents were enriched from the whole collection up front, so records
+  # can go in in any order.
+  total_records_created = insert_records(records_to_create, metrics,
+    options.batch_size, options.workers, note_result, resolver)
+  journal.close()
+  if isinstance(existing_cspace_records, ExistenceIndex):
+    existing_cspace_records.close()
+  if staging_store is not None:
+    staging_store.close()
 
+  metrics.count('created', total_records_created)
+  for counter, value in shared_client().stats().items():
+    metrics.count(counter, value)
+  if resolver is not None:
+    for counter, value in resolver.stats().items():
+      metrics.count(counter, value)
+  print metrics.progress_line()
+  metrics.write_summary()
   print "All records processed. Created %s new records.\n" % total_records_created
@@ -2,7 +2,25 @@
 # vim: set fileencoding=utf-8 :
 
 import create_cspace_records
+import dates
+import dimensions
+import existence_index
+import journal
+import json
+import metrics
+import multiprocessing.pool
+import records
+import os
+import pipeline
+import re
+import shutil
+import staging
+import tempfile
+import threading
+import time
 import unittest
+import wacart
+from read_test import mockExport
 
 class TestParsing(unittest.TestCase):
 
@@ -18,6 +36,15 @@ class TestParsing(unittest.TestCase):
      self.assertTrue(some_xml.find('Clarity') > -1)
      self.assertTrue(some_xml.find('2020.142') > -1)
 
+  def testAmpersandsEscapedOnce(self):
+     simpleRecord = {'acc_no': u'2020.142.4', 'title': [u'Salt & Pepper'],
+       'description': ['this & that']}
+     some_xml = create_cspace_records.xml_from(simpleRecord)
+     self.assertTrue(some_xml.find('Salt &amp; Pepper') > -1)
+     self.assertTrue(some_xml.find('this &amp; that') > -1)
+     self.assertEqual(-1, some_xml.find('&amp;amp;'))
+     self.assertEqual(['this & that'], simpleRecord['description'])
+
   def testConditionProcessing(self):
 
      simpleRecord = {
@@ -41,5 +68,554 @@ class TestParsing(unittest.TestCase):
 
      # then try a combo, eg. width and depth
 
+class TestDimensions(unittest.TestCase):
+
+  class FakeReport(object):
+    def __init__(self):
+      self.rows = []
+    def note(self, category, object_id, value):
+      self.rows.append((category, object_id, value))
+
+  def testTerms(self):
+    self.assertEqual([(12.5, 'length', 1.0, True)], dimensions.measurement_terms(u'12 1/2 in.'))
+    self.assertEqual([(12.5, 'length', 1.0, True)], dimensions.measurement_terms(u'12-1/2"'))
+    self.assertEqual([(30.5, 'length', 1 / 2.54, False)], dimensions.measurement_terms(u'30.5 cm'))
+    self.assertEqual(2, len(dimensions.measurement_terms(u'3 ft. 4 in.')))
+    self.assertEqual(None, dimensions.measurement_terms(u'12 x 14 in.'))
+    self.assertEqual(None, dimensions.measurement_terms(u'12'))
+    self.assertEqual(None, dimensions.measurement_terms(u'variable'))
+    self.assertEqual(None, dimensions.measurement_terms(u'3 lbs. 4 in.'))
+
+  def testAlternatives(self):
+    def totals(text):
+      return [round(sum([t[0] * t[2] for t in alternative]), 2) for alternative in
+        dimensions.measurement_alternatives(dimensions.measurement_terms(text))]
+    self.assertEqual([40.0], totals(u'3 ft. 4 in.'))
+    self.assertEqual([2.19], totals(u'2 lb. 3 oz.'))
+    self.assertEqual([12.0, 12.01], totals(u'12 in., 30.5 cm'))
+    self.assertEqual([12.0, 12.0], totals(u'12 in. 12 in.'))
+    self.assertEqual([4.0, 36.0], totals(u'4 in. 3 ft.'))
+    self.assertEqual([0.39, 12.0], totals(u'1 cm 12 in.'))
+
+  def testAlternativesInOneValue(self):
+    records = [{'object_id': u'1', 'width': [u'12 in., 30.5 cm']},
+      {'object_id': u'2', 'width': [u'12 in., 45 cm']}]
+    report = self.FakeReport()
+    self.assertEqual(1, dimensions.normalize_dimensions(records, report))
+    self.assertEqual([{'dimension': 'width', 'value': 12.0, 'unit': 'inches'}],
+      records[0]['measurements'])
+    self.assertEqual([{'dimension': 'width', 'value': 12.0, 'unit': 'inches'},
+      {'dimension': 'width', 'value': 17.72, 'unit': 'inches'}],
+      records[1]['measurements'])
+    self.assertEqual([('dimensions', u'2', u'width has 2 measurements: 12 in., 45 cm')],
+      report.rows)
+
+  def testMultiPartMeasurements(self):
+    records = [{'object_id': u'1',
+      'height': [u'12 in.', u'30.5 cm', u'8 in.', u'20.3 cm']}]
+    self.assertEqual(1, dimensions.normalize_dimensions(records))
+    self.assertEqual([{'dimension': 'height', 'value': 12.0, 'unit': 'inches'},
+      {'dimension': 'height', 'value': 8.0, 'unit': 'inches'}],
+      records[0]['measurements'])
+
+  def testNormalize(self):
+    records = [
+      {'object_id': u'1', 'width': [u'31.75 cm', u'12 1/2 in.'],
+       'height': [u'3 ft. 4 in.', u'102 cm'], 'weight': [u'2 kg']},
+      {'object_id': u'2', 'width': [u'12 1/2 in.'], 'depth': [u'variable'],
+       'weight': [u'10 in.']},
+      {'object_id': u'3', 'title': [u'no measurements']},
+      {'object_id': u'4', 'width': [u'85 in.', u'89 cm']},
+      ]
+    report = self.FakeReport()
+    self.assertEqual(3, dimensions.normalize_dimensions(records, report))
+    self.assertEqual([
+      {'dimension': 'width', 'value': 12.5, 'unit': 'inches'},
+      {'dimension': 'height', 'value': 40.0, 'unit': 'inches'},
+      {'dimension': 'weight', 'value': 4.41, 'unit': 'pounds'},
+      ], records[0]['measurements'])
+    self.assertEqual([{'dimension': 'width', 'value': 12.5, 'unit': 'inches'}],
+      records[1]['measurements'])
+    self.assertFalse(records[2].has_key('measurements'))
+    self.assertEqual([{'dimension': 'width', 'value': 85.0, 'unit': 'inches'},
+      {'dimension': 'width', 'value': 35.04, 'unit': 'inches'}],
+      records[3]['measurements'])
+    self.assertEqual([('dimensions', u'2', u'depth: variable'),
+      ('dimensions', u'2', u'weight: 10 in.'),
+      ('dimensions', u'4', u'width has 2 measurements: 85 in. / 89 cm')], report.rows)
+
+  def testXml(self):
+    records = [{'acc_no': u'2020.142.7', 'running_time': u'234',
+      'width': [u'12 1/2 in.', u'31.75 cm'], 'weight': [u'8 oz']}]
+    dimensions.normalize_dimensions(records)
+    some_xml = create_cspace_records.xml_from(records[0])
+    self.assertEqual(1, some_xml.count('<collectionobjects_common:dimensionList>'))
+    self.assertEqual(3, some_xml.count('<collectionobjects_common:dimensionGroup>'))
+    self.assertTrue(some_xml.find('12.50') > -1)
+    self.assertTrue(some_xml.find('pounds') > -1)
+    self.assertTrue(some_xml.find('0.50') > -1)
+
+class TestDates(unittest.TestCase):
+
+  def testParse(self):
+    self.assertEqual({'display': u'1984', 'earliest': 1984, 'latest': 1984,
+      'circa': False}, dates.parse_date(u' 1984'))
+    date = dates.parse_date(u'c. 1984-86')
+    self.assertEqual((1984, 1986, True), (date['earliest'], date['latest'], date['circa']))
+    date = dates.parse_date(u'1960s')
+    self.assertEqual((1960, 1969), (date['earliest'], date['latest']))
+    date = dates.parse_date(u'11/14/2020')
+    self.assertEqual((2020, 2020), (date['earliest'], date['latest']))
+    date = dates.parse_date(u'n.d.')
+    self.assertEqual((u'n.d.', None, None), (date['display'], date['earliest'], date['latest']))
+
+  def testShortRanges(self):
+    for text, years in [(u'1910-12', (1910, 1912)), (u'1984 – 86', (1984, 1986)),
+        (u'1995-05', (1995, 1995)), (u'1999-01', (1999, 1999)),
+        (u'1998-02', (1998, 1998)), (u'1998-45', (1998, 2045)),
+        (u'2001-02-03', (2001, 2001)), (u'1999-12-31', (1999, 1999))]:
+      date = dates.parse_date(text)
+      self.assertEqual(years, (date['earliest'], date['latest']), text)
+
+  def testDistinctValuesParsedOnce(self):
+    records = [{'date': u'ca. 1972', 'agents': [{'born': u'1940', 'died': u'1999'}]},
+      {'date': u'ca. 1972', 'agents': [{'born': u'1940', 'author_death_year': u'n.d.'}]}]
+    self.assertEqual(1, dates.normalize_dates(records))
+    self.assertTrue(records[0]['production_date'] is records[1]['production_date'])
+    self.assertTrue(records[0]['agents'][0]['birth_date'] is records[1]['agents'][0]['birth_date'])
+    self.assertEqual(1999, records[0]['agents'][0]['death_date']['latest'])
+    self.assertEqual(None, records[1]['agents'][0]['death_date']['earliest'])
+
+  def testXml(self):
+    records = [{'acc_no': u'2020.142.8', 'date': u'c. 1984-86'},
+      {'acc_no': u'2020.142.9', 'date': u'n.d.'}]
+    dates.normalize_dates(records)
+    some_xml = create_cspace_records.xml_from(records[0])
+    self.assertTrue(some_xml.find('dateDisplayDate>c. 1984-86<') > -1)
+    self.assertTrue(some_xml.find('dateEarliestSingleYear>1984<') > -1)
+    self.assertTrue(some_xml.find('dateLatestYear>1986<') > -1)
+    self.assertTrue(some_xml.find('dateEarliestSingleCertainty>circa<') > -1)
+    some_xml = create_cspace_records.xml_from(records[1])
+    self.assertTrue(some_xml.find('dateDisplayDate>n.d.<') > -1)
+    self.assertEqual(-1, some_xml.find('dateEarliestSingleYear'))
+
+class TestAgentIndex(unittest.TestCase):
+
+  def testMultiArtistRecordsEnriched(self):
+    records = [
+      {'acc_no': '1', 'agents': [{'last_name': 'Doe', 'first_name': 'John',
+        'agent_type': 'artist', 'born': '1900', 'nationality': 'American'}]},
+      {'acc_no': '2', 'agents': [{'last_name': 'Doe', 'first_name': 'John',
+        'agent_type': 'artist', 'born': '1900', 'nationality': 'Canadian'}]},
+      {'acc_no': '3', 'agents': [{'last_name': 'Doe', 'first_name': 'John',
+        'agent_type': 'artist', 'born': '1901', 'nationality': 'American'}]},
+      {'acc_no': '4', 'agents': [{'last_name': 'Roe', 'first_name': 'Jane',
+        'agent_type': 'author', 'author_birth_place': 'Boston'}]},
+      {'acc_no': '5', 'agents': [
+        {'last_name': 'Roe', 'first_name': 'Jane', 'agent_type': 'artist'},
+        {'last_name': 'DOE', 'first_name': 'John', 'agent_type': 'artist',
+         'born': '1899'}]},
+      ]
+    index = create_cspace_records.build_agent_index(records)
+    self.assertEqual({'born': '1900', 'nationality': 'American'}, index['john doe'])
+    self.assertEqual({'birth_place': 'Boston'}, index['jane roe'])
+
+    self.assertEqual(2, create_cspace_records.enrich_agents(records[4:], index))
+    self.assertEqual('Boston', records[4]['agents'][0]['birth_place'])
+    self.assertEqual('1899', records[4]['agents'][1]['born'])
+    self.assertEqual('American', records[4]['agents'][1]['nationality'])
+
+  def testSelectionEnrichedFromWholeStore(self):
+    handle, filename = tempfile.mkstemp()
+    os.close(handle)
+    try:
+      store = wacart.OUTPUT_WRITERS['sqlite'](filename)
+      for acc_no, classification, born in [('2003.1', 'Print', ''),
+          ('2003.2', 'Painting', '1900')]:
+        objekt, agents = wacart.parse_line(mockExport({'acc_no': acc_no,
+          'classification': classification, 'creator_text_inverted': 'Doe, John',
+          'born': born}))
+        objekt['agents'] = agents
+        store.write(objekt)
+      store.close()
+
+      store = staging.StagingStore(filename)
+      prints = create_cspace_records.load_staged_objects(store, 'Print')
+      self.assertEqual(0, create_cspace_records.enrich_agents(prints,
+        create_cspace_records.build_agent_index(prints)))
+      self.assertEqual(1, create_cspace_records.enrich_agents(prints,
+        create_cspace_records.build_agent_index(store.select())))
+      self.assertEqual('1900', prints[0]['agents'][0]['born'])
+      store.close()
+    finally:
+      os.remove(filename)
+
+class TestBatches(unittest.TestCase):
+
+  def setUp(self):
+    self.records = [{'acc_no': '2020.142.%s' % i, 'title': ['t%s' % i]} for i in range(5)]
+    self.posted = []
+    self.real_post_imports = create_cspace_records.post_imports
+    create_cspace_records.post_imports = self.fake_post_imports
+
+  def tearDown(self):
+    create_cspace_records.post_imports = self.real_post_imports
+
+  def fake_post_imports(self, object_xml, metrics, count=1):
+    """Fails any document containing record 3, and reports record 4 as
+    failed in a document that otherwise goes in"""
+    self.posted.append(count)
+    if object_xml.find('2020.142.3') > -1:
+      return {'status': '500'}, 'nope'
+    seqs = re.findall(r'seq="(\d+)"', object_xml)
+    numbers = re.findall(r'2020\.142\.(\d+)<', object_xml)
+    results = []
+    for seq, number in zip(seqs, numbers):
+      if number == '4':
+        results.append('<import-result seq="%s" state="ERROR"><error>bad '
+          'vocabulary term</error></import-result>' % seq)
+      else:
+        results.append('<import-result seq="%s" state="OK"/>' % seq)
+    return {'status': '200'}, '<import-results>%s</import-results>' % ''.join(results)
+
+  def testDocumentSequence(self):
+    some_xml = create_cspace_records.imports_document(self.records[:3])
+    self.assertEqual(3, some_xml.count('<import '))
+    self.assertTrue(some_xml.find('seq="3"') > -1)
+    self.assertEqual(create_cspace_records.xml_from(self.records[0]),
+      create_cspace_records.imports_document(self.records[:1]))
+
+  def testFailingBatchIsSplit(self):
+    results = create_cspace_records.insert_batch_into_cspace(self.records)
+    self.assertEqual([1, 1, 1, 0, 0], results)
+    self.assertEqual(5, self.posted[0])
+
+  def testImportOutcomes(self):
+    self.assertEqual([None, 'bad term', 'ERROR', 'not in the import-result report'],
+      create_cspace_records.import_outcomes('<import-results>'
+        '<import-result seq="1" state="OK"/>'
+        '<import-result><seq>2</seq><error>bad term</error></import-result>'
+        '<import-result seq="3" state="ERROR"/></import-results>', 4))
+    self.assertEqual(None, create_cspace_records.import_outcomes('', 2))
+    self.assertEqual(None, create_cspace_records.import_outcomes('<html>ok</html>', 2))
+    # with no report, the status is all there is
+    self.assertEqual([1, 1], create_cspace_records.report_inserts(self.records[:2],
+      {'status': '200'}, ''))
+    self.assertEqual([0, 0], create_cspace_records.report_inserts(self.records[:2],
+      {'status': '500'}, '<import-result seq="1" state="OK"/>'))
+
+  def testConcurrentInsert(self):
+    run = metrics.Metrics('test', interval=3600)
+    created = create_cspace_records.insert_records(self.records, run, workers=3)
+    self.assertEqual(3, created)
+    self.assertEqual(5, run.done)
+
+    run = metrics.Metrics('test', interval=3600)
+    created = create_cspace_records.insert_records(self.records, run,
+      batch_size=2, workers=2)
+    self.assertEqual(3, created)
+    self.assertEqual(5, run.done)
+
+  def testExportMatchesLivePost(self):
+    directory = tempfile.mkdtemp()
+    try:
+      self.records[1]['title'] = [u'Tom\xe9e & stuff']
+      live = [create_cspace_records.imports_document(self.records[i:i + 2])
+        for i in range(0, 5, 2)]
+      filenames = create_cspace_records.export_imports(iter(self.records),
+        os.path.join(directory, 'wac'), 2)
+      self.assertEqual(3, len(filenames))
+      self.assertTrue(filenames[2].endswith('wac-0003.xml'))
+      for i in range(3):
+        self.assertEqual(live[i].encode('utf-8'), open(filenames[i], 'rb').read())
+    finally:
+      shutil.rmtree(directory)
+
+  def testBatches(self):
+    sizes = [len(b) for b in create_cspace_records.batches(self.records, 2)]
+    self.assertEqual([2, 2, 1], sizes)
+
+class TestPipeline(unittest.TestCase):
+
+  class Tee(object):
+    def __init__(self):
+      self.records = []
+    def write(self, objekt):
+      self.records.append(objekt)
+
+  def setUp(self):
+    handle, self.filename = tempfile.mkstemp()
+    tabfile = os.fdopen(handle, 'wb')
+    for i in range(20):
+      fields = {'acc_no': '2020.142.%s' % i, 'title': 'foo %s' % i,
+        'creator_text_inverted': 'Doe, John', 'date': 'c. 1984',
+        'width': '12 1/2 in.'}
+      if i == 5:
+        fields['frame'] = 'maybe'
+      tabfile.write(mockExport(fields) + "\n")
+    tabfile.close()
+    self.posted = []
+    self.release = threading.Event()
+    self.release.set()
+    self.real_post_imports = create_cspace_records.post_imports
+    create_cspace_records.post_imports = self.fake_post_imports
+
+  def tearDown(self):
+    create_cspace_records.post_imports = self.real_post_imports
+    os.remove(self.filename)
+
+  def fake_post_imports(self, object_xml, metrics, count=1):
+    """Fails any document containing record 13"""
+    self.release.wait()
+    self.posted.append(object_xml)
+    if object_xml.find('2020.142.13<') > -1:
+      return {'status': '500'}, 'nope'
+    return {'status': '200'}, ''
+
+  def testStreamsToPost(self):
+    run = metrics.Metrics('test', interval=3600)
+    results = {}
+    def note_result(record, result):
+      results[record['acc_no']] = result
+    line = pipeline.Pipeline(self.filename, lambda: set([u'2020.142.0', u'2020.142.1']),
+      run, batch_size=3, workers=2, on_result=note_result)
+    self.assertEqual(17, line.run())
+    self.assertEqual(18, len(results))
+    self.assertEqual(0, results[u'2020.142.13'])
+    self.assertEqual(18, run.done)
+    self.assertEqual(2, run.counters['pruned'])
+    self.assertTrue(self.posted[0].find('dateEarliestSingleYear>1984<') > -1)
+    self.assertTrue(self.posted[0].find('>12.50<') > -1)
+
+  def testOdditiesReported(self):
+    class ParseReport(object):
+      def __init__(self):
+        self.rows = []
+      def note(self, category, object_id, value):
+        self.rows.append((category, object_id, value))
+    parse_report = ParseReport()
+    line = pipeline.Pipeline(self.filename, set(), metrics.Metrics('test', interval=3600),
+      parse_report=parse_report)
+    line.run()
+    expected = []
+    for objekt, agents in wacart.parse_file(self.filename):
+      objekt['agents'] = agents
+      expected += wacart.find_oddities(objekt)
+    self.assertEqual(1, len(expected))
+    self.assertEqual(expected, parse_report.rows)
+
+  def testBackpressure(self):
+    self.release.clear()
+    tee = self.Tee()
+    line = pipeline.Pipeline(self.filename, set(), metrics.Metrics('test', interval=3600),
+      tee=tee, queue_size=1)
+    thread = threading.Thread(target=line.run)
+    thread.start()
+    time.sleep(0.5)
+    # one each being POSTed, serialized, pruned and parsed, and one in
+    # each of the three queues
+    self.assertTrue(len(tee.records) <= 7)
+    self.release.set()
+    thread.join()
+    self.assertEqual(20, len(tee.records))
+    self.assertEqual(19, line.created)
+
+  def testBackpressureWithParseWorkers(self):
+    tabfile = open(self.filename, 'wb')
+    for i in range(200):
+      tabfile.write(mockExport({'acc_no': '2021.%s' % i, 'title': 'foo %s' % i,
+        'creator_text_inverted': 'Doe, John'}) + "\n")
+    tabfile.close()
+    submitted = []
+    class CountingPool(multiprocessing.pool.Pool):
+      def apply_async(self, function, args=(), kwds={}, callback=None):
+        submitted.append(args)
+        return multiprocessing.pool.Pool.apply_async(self, function, args, kwds, callback)
+    chunks = len(wacart.chunk_offsets(self.filename, 500))
+    self.release.clear()
+    tee = self.Tee()
+    line = pipeline.Pipeline(self.filename, set(), metrics.Metrics('test', interval=3600),
+      tee=tee, queue_size=1, parse_workers=2, parse_chunk_size=500)
+    real_pool = wacart.Pool
+    wacart.Pool = CountingPool
+    try:
+      thread = threading.Thread(target=line.run)
+      thread.start()
+      time.sleep(0.5)
+      blocked = (len(tee.records), len(submitted))
+      self.release.set()
+      thread.join()
+    finally:
+      wacart.Pool = real_pool
+    self.assertTrue(blocked[0] <= 7)
+    # the few chunks those records came from, and two per worker ahead
+    self.assertTrue(0 < blocked[1] <= 2 * wacart.CHUNKS_IN_FLIGHT + 3)
+    self.assertTrue(blocked[1] < chunks)
+    self.assertEqual(200, len(tee.records))
+    self.assertEqual(200, line.created)
+
+  def testFailureStopsEveryStage(self):
+    def broken():
+      raise IOError('no listing')
+    line = pipeline.Pipeline(self.filename, broken, metrics.Metrics('test', interval=3600),
+      queue_size=1)
+    self.assertRaises(IOError, line.run)
+
+class TestExistenceIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'objects.index')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testBuildAddRemove(self):
+    self.assertFalse(existence_index.index_exists(self.filename))
+    existence_index.build_index(['2003.1', u'2003.2', None], self.filename)
+    self.assertTrue(existence_index.index_exists(self.filename))
+
+    index = existence_index.ExistenceIndex(self.filename)
+    self.assertTrue('2003.1' in index)
+    self.assertTrue(u'2003.2' in index)
+    self.assertFalse('2003.3' in index)
+    index.add(u'2003.3')
+    index.remove('2003.1')
+    index.close()
+
+    index = existence_index.ExistenceIndex(self.filename)
+    self.assertEqual(['2003.2', '2003.3'], sorted(index))
+    records = [{'acc_no': '2003.1'}, {'acc_no': '2003.2'}]
+    self.assertEqual([{'acc_no': '2003.1'}],
+      create_cspace_records.prune_existing_records(records, index))
+    index.close()
+
+class TestJournal(unittest.TestCase):
+
+  def setUp(self):
+    handle, self.filename = tempfile.mkstemp()
+    os.close(handle)
+
+  def tearDown(self):
+    os.remove(self.filename)
+
+  def testSuccessesSurviveRestart(self):
+    log = journal.Journal(self.filename, append=False)
+    log.note(u'2003.1', 1)
+    log.note('2003.2', 0)
+    log.close()
+    log = journal.Journal(self.filename)
+    log.note('2003.3', 1)
+    log.close()
+    # a torn write from a crash
+    open(self.filename, 'a').write('created\t2003.')
+
+    created = journal.journaled_successes(self.filename)
+    self.assertEqual(set([u'2003.1', u'2003.3']), created)
+    records = [{'acc_no': '2003.%s' % i} for i in range(1, 5)]
+    self.assertEqual(['2003.2', '2003.4'], [r['acc_no'] for r in
+      create_cspace_records.prune_existing_records(records, created)])
+
+    journal.Journal(self.filename, append=False).close()
+    self.assertEqual(set(), journal.journaled_successes(self.filename))
+
+  def testAppendAfterTornLine(self):
+    log = journal.Journal(self.filename, append=False)
+    log.note('2003.1', 1)
+    log.close()
+    open(self.filename, 'a').write('created\t2003.')
+    log = journal.Journal(self.filename)
+    log.note('2003.5', 1)
+    log.close()
+    self.assertEqual("created\t2003.1\ncreated\t2003.5\n", open(self.filename).read())
+    self.assertEqual(set([u'2003.1', u'2003.5']), journal.journaled_successes(self.filename))
+
+    # nothing but a torn line
+    open(self.filename, 'w').write('crea')
+    journal.Journal(self.filename).close()
+    self.assertEqual('', open(self.filename).read())
+
+class TestCompactRecords(unittest.TestCase):
+
+  def setUp(self):
+    self.record = {'acc_no': u'2020.142.5', 'title': [u'Salt & Pepper'],
+      'classification': u'Painting', 'running_time': u'234',
+      'agents': [{'last_name': u'Doe', 'first_name': u'John',
+        'agent_type': u'artist', 'hobby': u'chess'}],
+      'not_a_column': 1}
+
+  def testRoundTrip(self):
+    compact = records.compact_record(self.record)
+    self.assertEqual(self.record, compact.to_dict())
+    self.assertEqual(json.dumps(self.record, sort_keys=True),
+      json.dumps(compact.to_dict(), sort_keys=True))
+
+  def testSharedStringsScopedToALoad(self):
+    shared = {}
+    first = records.compact_record(json.loads(json.dumps(self.record)), shared)
+    second = records.compact_record(json.loads(json.dumps(self.record)), shared)
+    self.assertTrue(first['classification'] is second['classification'])
+    self.assertTrue(first['agents'][0]['last_name'] is second['agents'][0]['last_name'])
+    self.assertFalse(first['acc_no'] is second['acc_no'])
+    self.assertTrue(shared.has_key(u'Painting'))
+    self.assertFalse(hasattr(records, 'shared_values'))
+
+    first = records.compact_record(json.loads(json.dumps(self.record)))
+    second = records.compact_record(json.loads(json.dumps(self.record)))
+    self.assertFalse(first['classification'] is second['classification'])
+
+  def testDictAccess(self):
+    compact = records.compact_record(self.record)
+    self.assertTrue(compact.has_key('acc_no'))
+    self.assertFalse(compact.has_key('date'))
+    self.assertEqual(None, compact.get('date'))
+    self.assertRaises(KeyError, lambda: compact['date'])
+    compact['date'] = u'1984'
+    compact['acc_no'] = u'2020.142.6'
+    self.assertEqual(u'1984', compact['date'])
+    self.assertEqual(u'2020.142.6', compact['acc_no'])
+    del compact['title']
+    self.assertFalse('title' in compact)
+    self.assertEqual(u'Painting', compact['classification'])
+    self.assertEqual(u'chess', compact['agents'][0]['hobby'])
+
+  def testXmlMatchesDict(self):
+    compact = records.compact_record(self.record)
+    self.assertEqual(create_cspace_records.xml_from(self.record),
+      create_cspace_records.xml_from(compact))
+
+  def testEnrichCompactAgents(self):
+    compact = [records.compact_record(self.record), records.compact_record(
+      {'acc_no': u'1', 'agents': [{'last_name': u'Doe', 'first_name': u'John',
+        'agent_type': u'artist', 'born': u'1900'}]})]
+    index = create_cspace_records.build_agent_index(compact)
+    self.assertEqual(1, create_cspace_records.enrich_agents(compact, index))
+    self.assertEqual(u'1900', compact[0]['agents'][0]['born'])
+
+class TestMetrics(unittest.TestCase):
+
+  def testStagesAndSummary(self):
+    run = metrics.Metrics('test', total=4, interval=3600)
+    with run.timer('serialize'):
+      create_cspace_records.xml_from({'acc_no': '2020.142.3'})
+    with run.timer('post') as timer:
+      timer.fail()
+    run.record('post', 20.0)
+    run.advance(2)
+    self.assertTrue(run.progress_line().find('2/4 records') > -1)
+
+    handle, filename = tempfile.mkstemp()
+    os.close(handle)
+    run.write_summary(filename)
+    run.write_summary(filename)
+    lines = open(filename).readlines()
+    os.remove(filename)
+    self.assertEqual(2, len(lines))
+    summary = json.loads(lines[0])
+    self.assertEqual(1, summary['stages']['serialize']['count'])
+    self.assertEqual(2, summary['stages']['post']['count'])
+    self.assertEqual(1, summary['stages']['post']['failures'])
+    self.assertEqual(1, summary['stages']['post']['histogram']['>10.0'])
+
 if __name__ == "__main__":
     unittest.main()   
@@ -3,3 +3,14 @@ CSPACE_USER = 'admin@walkerart.org'
 CSPACE_PASS = 'Administrator'
 CS_OBJECT_FILE = 'collectionspace_objects.pickle'
 WAC_OBJECTS_FILE= 'wacart_objects.json'
+METRICS_FILE = 'run_metrics.jsonl'
+CSPACE_TIMEOUT = 60 # seconds
+CSPACE_POOL_SIZE = 4
+CS_INDEX_FILE = 'collectionspace_objects.index'
+CSPACE_PAGE_SIZE = 500
+CS_CACHE_STATE_FILE = 'collectionspace_objects.state.json'
+CS_RECONCILE_DAYS = 7 # full re-list at least this often, to catch deletes
+WAC_STAGING_FILE = 'wacart_objects.sqlite'
+IMPORT_JOURNAL_FILE = 'import_journal.log'
+PERSON_AUTHORITY_CSID = '' # csid of the person authority agents go into
+PIPELINE_QUEUE_SIZE = 16 # items waiting between each pair of pipeline.py stages
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+A reusable CollectionSpace REST client. Keeps a pool of keep-alive
+httplib2 connections and sends basic auth with every request, rather
+than waiting for the server's 401 challenge.
+"""
+
+import base64
+import httplib2
+import threading
+import Queue
+import urlparse
+
+from csconstants import *
+
+class CSpaceClient(object):
+  """Thread-safe client for the services at url. At most pool_size
+  requests are in flight at once; further callers wait for a free
+  connection."""
+
+  def __init__(self, url=CSPACE_URL, user=CSPACE_USER, password=CSPACE_PASS,
+               timeout=CSPACE_TIMEOUT, pool_size=CSPACE_POOL_SIZE):
+    self.url = url
+    self.timeout = timeout
+    self.pool_size = pool_size
+    self.authorization = 'Basic ' + base64.b64encode('%s:%s' % (user, password))
+    parts = urlparse.urlsplit(url)
+    self.connection_key = '%s:%s' % (parts.scheme, parts.netloc)
+    self.pool = Queue.Queue(pool_size)
+    self.created = 0
+    self.lock = threading.Lock()
+    self.connections_opened = 0
+    self.connections_reused = 0
+    self.requests = 0
+
+  def acquire(self):
+    self.lock.acquire()
+    try:
+      if self.pool.empty() and self.created < self.pool_size:
+        self.created += 1
+        return httplib2.Http(timeout=self.timeout)
+    finally:
+      self.lock.release()
+    return self.pool.get()
+
+  def release(self, http):
+    self.pool.put(http)
+
+  def request(self, path, method='GET', body=None, headers=None):
+    """Makes a request against a path relative to the services url.
+    Returns httplib2's (response, content)."""
+    all_headers = {'Authorization': self.authorization}
+    if headers is not None:
+      all_headers.update(headers)
+    http = self.acquire()
+    try:
+      connection = http.connections.get(self.connection_key)
+      reused = connection is not None and connection.sock is not None
+      resp, content = http.request(self.url + path, method, body=body,
+        headers=all_headers)
+    finally:
+      self.release(http)
+    self.lock.acquire()
+    try:
+      self.requests += 1
+      if reused:
+        self.connections_reused += 1
+      else:
+        self.connections_opened += 1
+    finally:
+      self.lock.release()
+    return resp, content
+
+  def get(self, path):
+    return self.request(path, 'GET')
+
+  def post_xml(self, path, xml):
+    return self.request(path, 'POST', body=xml,
+      headers={'Content-Type': 'application/xml'})
+
+  def stats(self):
+    return {
+      'requests': self.requests,
+      'connections_opened': self.connections_opened,
+      'connections_reused': self.connections_reused,
+      }
+
+shared = None
+shared_lock = threading.Lock()
+
+def shared_client():
+  """The client every part of a run should use, created on first
+  call."""
+  global shared
+  shared_lock.acquire()
+  try:
+    if shared is None:
+      shared = CSpaceClient()
+    return shared
+  finally:
+    shared_lock.release()
+
+def set_shared_client(client):
+  """Replaces the shared client, e.g. with one whose pool is sized for
+  more concurrent requests."""
+  global shared
+  shared_lock.acquire()
+  try:
+    shared = client
+  finally:
+    shared_lock.release()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Normalizes the free-text dates of parsed WACArt records (production
+dates, and agents' birth and death years) to earliest and latest years
+plus a display string, for CollectionSpace structured date groups. There
+are far fewer distinct date strings than records, so each is parsed once
+per run and the result shared.
+"""
+
+import re
+
+from lxml.builder import E
+
+# field the parsed date is put in -> fields it's parsed from, in order
+# of preference
+RECORD_DATE_FIELDS = [
+  ('production_date', ['date']),
+  ]
+AGENT_DATE_FIELDS = [
+  ('birth_date', ['born']),
+  ('death_date', ['died', 'author_death_year']),
+  ]
+
+YEAR = re.compile(r'(?<!\d)(1\d{3}|20\d{2})(?!\d)')
+
+# 1984-86, or 1998-45 into the next century. Not 2001-02-03, and see
+# read_date for 1998-02.
+SHORT_RANGE = re.compile(u'(?<!\\d)(1\\d{3}|20\\d{2})\\s*[-–]\\s*(\\d{2})(?!\\d)(?!\\s*[-–]\\s*\\d)', re.UNICODE)
+
+# 1980s
+DECADE = re.compile(r'(?<!\d)(1\d{2}|20\d)0s')
+
+CIRCA = re.compile(r'^\s*(c\.|ca\.?|circa)\s*\d', re.IGNORECASE)
+
+parsed_dates = {}
+
+def parse_date(text):
+  """A dict with the display string, the earliest and latest years
+  mentioned (None if there aren't any), and whether it's a circa date.
+  Remembered for the rest of the run; the dict is shared, so don't
+  change it."""
+  parsed = parsed_dates.get(text)
+  if parsed is None:
+    parsed = parsed_dates.setdefault(text, read_date(text))
+  return parsed
+
+def read_date(text):
+  years = [int(year) for year in YEAR.findall(text)]
+  for start, end in SHORT_RANGE.findall(text):
+    year = int(start[:2] + end)
+    # 1998-02 is far more likely February 1998 than 1998 to 2002
+    if year < int(start):
+      if 1 <= int(end) <= 12:
+        continue
+      year += 100
+    years.append(year)
+  for decade in DECADE.findall(text):
+    years += [int(decade + '0'), int(decade + '9')]
+  date = {'display': text.strip(), 'earliest': None, 'latest': None,
+    'circa': CIRCA.match(text) is not None}
+  if len(years) > 0:
+    date['earliest'] = min(years)
+    date['latest'] = max(years)
+  return date
+
+def first_value(holder, fields):
+  for field in fields:
+    value = holder.get(field)
+    if type(value) == type([]) and len(value) > 0:
+      value = value[0]
+    if value:
+      return value
+  return None
+
+def normalize_dates(records):
+  """
+  Sets the fields in RECORD_DATE_FIELDS and AGENT_DATE_FIELDS on each
+  record, and each of its agents, that has a date to parse. Returns the
+  number of dates set that have no year in them.
+  """
+  yearless = 0
+  for record in records:
+    holders = [(record, RECORD_DATE_FIELDS)]
+    for agent in record.get('agents', []):
+      holders.append((agent, AGENT_DATE_FIELDS))
+    for holder, date_fields in holders:
+      for parsed_field, fields in date_fields:
+        text = first_value(holder, fields)
+        if text is None:
+          continue
+        date = parse_date(text)
+        holder[parsed_field] = date
+        if date['earliest'] is None:
+          yearless += 1
+  return yearless
+
+def date_group_fields(date, maker=E):
+  """The elements of a structured date group for a parsed date, made
+  with maker."""
+  fields = [maker.dateDisplayDate(date['display'])]
+  if date['earliest'] is not None:
+    fields.append(maker.dateEarliestSingleYear(str(date['earliest'])))
+    if date['circa']:
+      fields.append(maker.dateEarliestSingleCertainty('circa'))
+    fields.append(maker.dateLatestYear(str(date['latest'])))
+    if date['circa']:
+      fields.append(maker.dateLatestCertainty('circa'))
+  return fields
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Normalizes the free-text width, depth, height and weight fields of
+parsed WACArt records to inches and pounds, for dimensionGroup elements.
+Each distinct string in the collection is parsed once; the unit
+conversions for all of them are then done together, with numpy if it's
+installed.
+"""
+
+import re
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# field -> kind of measurement it should hold
+MEASURED_FIELDS = [
+  ('width', 'length'),
+  ('height', 'length'),
+  ('depth', 'length'),
+  ('weight', 'weight'),
+  ]
+
+# kind -> the unit everything of that kind is converted to
+NORMAL_UNITS = {
+  'length': 'inches',
+  'weight': 'pounds',
+  }
+
+# unit as written (lower case, no trailing period) -> (kind, factor)
+UNITS = {
+  u'in': ('length', 1.0),
+  u'inch': ('length', 1.0),
+  u'inches': ('length', 1.0),
+  u'"': ('length', 1.0),
+  u'ft': ('length', 12.0),
+  u'foot': ('length', 12.0),
+  u'feet': ('length', 12.0),
+  u"'": ('length', 12.0),
+  u'mm': ('length', 1 / 25.4),
+  u'cm': ('length', 1 / 2.54),
+  u'm': ('length', 100 / 2.54),
+  u'lb': ('weight', 1.0),
+  u'lbs': ('weight', 1.0),
+  u'pound': ('weight', 1.0),
+  u'pounds': ('weight', 1.0),
+  u'oz': ('weight', 1 / 16.0),
+  u'g': ('weight', 1 / 453.59237),
+  u'kg': ('weight', 1000 / 453.59237),
+  }
+
+# Units a field's value is taken from, when it's given in more than one
+IMPERIAL_UNITS = set([u'in', u'inch', u'inches', u'"', u'ft', u'foot',
+  u'feet', u"'", u'lb', u'lbs', u'pound', u'pounds', u'oz'])
+
+# How far apart, as a fraction of the larger, the same measurement in
+# different units can be before they're reported as disagreeing. Metric
+# equivalents tend to be rounded.
+DISAGREEMENT_TOLERANCE = 0.02
+
+# A number, which may be a decimal, a fraction, or a whole number and a
+# fraction ("12 1/2", "12-1/2"), then a unit.
+MEASUREMENT_TERM = re.compile(r"""
+  (?: (?P<whole>\d+(?:\.\d*)?|\.\d+) (?:[\s-]+(?P<num>\d+)/(?P<den>\d+))?
+    | (?P<fnum>\d+)/(?P<fden>\d+) )
+  \s* (?P<unit>[a-z]+|"|') \.?
+  """, re.VERBOSE | re.IGNORECASE | re.UNICODE)
+
+# What may be left over once the terms are taken out
+FILLER = re.compile(r'^[\s.,;:+&]*$', re.UNICODE)
+
+def measurement_terms(text):
+  """The (magnitude, kind, factor, imperial) terms of a measurement like
+  '12 1/2 in.' or '3 ft. 4 in.', or None if text isn't one: a unit we
+  don't know, a number without a unit, units of different kinds, or
+  anything else left over."""
+  terms = []
+  for match in MEASUREMENT_TERM.finditer(text):
+    unit_name = match.group('unit').lower()
+    unit = UNITS.get(unit_name)
+    if unit is None:
+      return None
+    if match.group('fnum') is not None:
+      if int(match.group('fden')) == 0:
+        return None
+      magnitude = float(match.group('fnum')) / int(match.group('fden'))
+    else:
+      magnitude = float(match.group('whole'))
+      if match.group('num') is not None:
+        if int(match.group('den')) == 0:
+          return None
+        magnitude += float(match.group('num')) / int(match.group('den'))
+    terms.append((magnitude, unit[0], unit[1], unit_name in IMPERIAL_UNITS))
+  if len(terms) == 0 or not FILLER.match(MEASUREMENT_TERM.sub(u'', text)):
+    return None
+  if len(set([term[1] for term in terms])) > 1:
+    return None
+  return terms
+
+def measurement_alternatives(terms):
+  """
+  Splits the terms of one value into the measurements they make up. Only
+  terms in one system going from larger units to smaller ('3 ft. 4 in.',
+  '2 lb. 3 oz.') are added together; anything else ('12 in., 30.5 cm',
+  '12 in. 12 in.') is the same measurement given more than once, so each
+  is its own alternative.
+  """
+  alternatives = [[terms[0]]]
+  for term in terms[1:]:
+    previous = alternatives[-1][-1]
+    if term[3] == previous[3] and term[2] < previous[2]:
+      alternatives[-1].append(term)
+    else:
+      alternatives.append([term])
+  return alternatives
+
+def convert(magnitudes, factors, owners, count):
+  """Sums magnitude * factor for each of count owners."""
+  if numpy is not None:
+    return numpy.bincount(numpy.array(owners, dtype=numpy.intp),
+      weights=numpy.array(magnitudes) * numpy.array(factors),
+      minlength=count).tolist()
+  totals = [0.0] * count
+  for i in range(len(owners)):
+    totals[owners[i]] += magnitudes[i] * factors[i]
+  return totals
+
+def measured_values(record, field):
+  value = record.get(field)
+  if value is None:
+    return []
+  if isinstance(value, basestring):
+    return [value]
+  return value
+
+def agree(values):
+  return max(values) - min(values) <= DISAGREEMENT_TOLERANCE * max(values)
+
+def normalize_dimensions(records, report=None):
+  """
+  Sets 'measurements' on each record with anything in MEASURED_FIELDS to
+  a list of {'dimension', 'value', 'unit'} dicts, one per distinct
+  measurement, in field order. A repeating field, or a single value, can
+  hold the same measurement in different units ('12 in.' and '30.5 cm'),
+  which makes one dict, with the imperial value if there is one. Values
+  that don't parse, and fields with more than one distinct measurement
+  (which may be parts of a multi-part work, or a mistake), are noted
+  under 'dimensions' in report, if given. Returns the number of those.
+  """
+  distinct = {}
+  texts = []
+  uses = []
+  for i in range(len(records)):
+    for field, kind in MEASURED_FIELDS:
+      indexes = []
+      for text in measured_values(records[i], field):
+        if not distinct.has_key(text):
+          distinct[text] = len(texts)
+          texts.append(text)
+        indexes.append(distinct[text])
+      if len(indexes) > 0:
+        uses.append((i, field, kind, indexes))
+
+  # Each distinct text has one or more alternative measurements; the
+  # terms of all of them are converted together.
+  magnitudes = []
+  factors = []
+  owners = []
+  kinds = []
+  alternatives = []
+  imperial = []
+  for j in range(len(texts)):
+    terms = measurement_terms(texts[j])
+    if terms is None:
+      kinds.append(None)
+      alternatives.append([])
+      continue
+    kinds.append(terms[0][1])
+    alternatives.append([])
+    for alternative in measurement_alternatives(terms):
+      alternatives[j].append(len(imperial))
+      for magnitude, kind, factor, is_imperial in alternative:
+        magnitudes.append(magnitude)
+        factors.append(factor)
+        owners.append(len(imperial))
+      imperial.append(alternative[0][3])
+  totals = convert(magnitudes, factors, owners, len(imperial))
+
+  measured = {}
+  problems = 0
+  for i, field, kind, indexes in uses:
+    parsed = []
+    for j in indexes:
+      if kinds[j] == kind:
+        parsed += alternatives[j]
+      else:
+        problems += 1
+        if report is not None:
+          report.note('dimensions', records[i].get('object_id'),
+            u'%s: %s' % (field, texts[j]))
+    if len(parsed) == 0:
+      continue
+    # Alternatives that agree are one measurement in different units;
+    # the rest are separate ones, like the parts of a multi-part work.
+    same = []
+    for k in parsed:
+      for alternatives_of_one in same:
+        if agree([totals[alternatives_of_one[0]], totals[k]]):
+          alternatives_of_one.append(k)
+          break
+      else:
+        same.append([k])
+    if len(same) > 1:
+      problems += 1
+      if report is not None:
+        report.note('dimensions', records[i].get('object_id'),
+          u'%s has %s measurements: %s' % (field, len(same), u' / '.join(
+            [texts[j] for j in indexes if kinds[j] == kind])))
+    for alternatives_of_one in same:
+      chosen = alternatives_of_one[0]
+      for k in alternatives_of_one:
+        if imperial[k]:
+          chosen = k
+          break
+      measured.setdefault(i, []).append({'dimension': field,
+        'value': round(totals[chosen], 2), 'unit': NORMAL_UNITS[kind]})
+  for i, measurements in measured.items():
+    records[i]['measurements'] = measurements
+  return problems
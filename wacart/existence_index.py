@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Index of the object numbers already in CollectionSpace. Kept on disk as
+a dbm hash file (whichever anydbm finds), so it opens without reading
+every key, answers membership with a hash lookup, and can be updated a
+key at a time as records are created.
+"""
+
+import anydbm
+import threading
+import whichdb
+
+from csconstants import *
+
+def key(object_number):
+  if isinstance(object_number, unicode):
+    return object_number.encode('utf-8')
+  return object_number
+
+class ExistenceIndex(object):
+  """Set-like view of a dbm file of object numbers. Safe to share
+  between threads."""
+
+  def __init__(self, filename=CS_INDEX_FILE, flag='c'):
+    self.filename = filename
+    self.db = anydbm.open(filename, flag)
+    self.lock = threading.Lock()
+
+  def __contains__(self, object_number):
+    if object_number is None:
+      return False
+    self.lock.acquire()
+    try:
+      return self.db.has_key(key(object_number))
+    finally:
+      self.lock.release()
+
+  def __len__(self):
+    return len(self.db)
+
+  def __iter__(self):
+    return iter([k.decode('utf-8') for k in self.db.keys()])
+
+  def add(self, object_number):
+    self.lock.acquire()
+    try:
+      self.db[key(object_number)] = ''
+    finally:
+      self.lock.release()
+
+  def remove(self, object_number):
+    self.lock.acquire()
+    try:
+      if self.db.has_key(key(object_number)):
+        del self.db[key(object_number)]
+    finally:
+      self.lock.release()
+
+  def sync(self):
+    self.lock.acquire()
+    try:
+      if hasattr(self.db, 'sync'):
+        self.db.sync()
+    finally:
+      self.lock.release()
+
+  def close(self):
+    self.db.close()
+
+def index_exists(filename=CS_INDEX_FILE):
+  return whichdb.whichdb(filename) is not None
+
+def build_index(object_numbers, filename=CS_INDEX_FILE):
+  """Replaces the index at filename with object_numbers."""
+  index = ExistenceIndex(filename, 'n')
+  for object_number in object_numbers:
+    if object_number is not None:
+      index.add(object_number)
+  index.close()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Append-only journal of import outcomes, so a run that dies part way can
+be resumed without re-listing CollectionSpace. One tab-separated
+"status, acc_no" line per record, fsynced in batches.
+"""
+
+import os
+import threading
+import time
+
+from csconstants import *
+
+CREATED = 'created'
+FAILED = 'failed'
+
+# fsync after this many entries, or this many seconds, whichever first
+FSYNC_EVERY = 100
+FSYNC_INTERVAL = 5.0
+
+def drop_torn_line(filename, block_size=4096):
+  """Truncates a journal back to just after its last newline, so a line
+  torn by a crash isn't run into the next one written."""
+  if not os.path.exists(filename):
+    return
+  journal_file = open(filename, 'r+b')
+  try:
+    end = os.fstat(journal_file.fileno()).st_size
+    keep = end
+    while keep > 0:
+      start = max(keep - block_size, 0)
+      journal_file.seek(start)
+      newline = journal_file.read(keep - start).rfind("\n")
+      if newline >= 0:
+        keep = start + newline + 1
+        break
+      keep = start
+    if keep < end:
+      journal_file.truncate(keep)
+  finally:
+    journal_file.close()
+
+class Journal(object):
+  """Safe to share between threads."""
+
+  def __init__(self, filename=IMPORT_JOURNAL_FILE, append=True):
+    if append:
+      drop_torn_line(filename)
+      mode = 'a'
+    else:
+      mode = 'w'
+    self.output = open(filename, mode)
+    self.lock = threading.Lock()
+    self.unsynced = 0
+    self.last_sync = time.time()
+
+  def note(self, acc_no, created):
+    if created:
+      status = CREATED
+    else:
+      status = FAILED
+    if isinstance(acc_no, unicode):
+      acc_no = acc_no.encode('utf-8')
+    self.lock.acquire()
+    try:
+      self.output.write("%s\t%s\n" % (status, acc_no))
+      self.unsynced += 1
+      if self.unsynced >= FSYNC_EVERY or time.time() - self.last_sync >= FSYNC_INTERVAL:
+        self.sync()
+    finally:
+      self.lock.release()
+
+  def sync(self):
+    """Call with the lock held."""
+    self.output.flush()
+    os.fsync(self.output.fileno())
+    self.unsynced = 0
+    self.last_sync = time.time()
+
+  def close(self):
+    self.lock.acquire()
+    try:
+      self.sync()
+      self.output.close()
+    finally:
+      self.lock.release()
+
+def journaled_successes(filename=IMPORT_JOURNAL_FILE):
+  """The acc_nos a journal says were created. A torn last line from a
+  crash is ignored."""
+  created = set()
+  if not os.path.exists(filename):
+    return created
+  journal_file = open(filename)
+  for line in journal_file:
+    if not line.endswith("\n"):
+      break
+    status, sep, acc_no = line[:-1].partition("\t")
+    if status == CREATED:
+      created.add(acc_no.decode('utf-8'))
+  journal_file.close()
+  return created
@@ -2,37 +2,191 @@
 
 """
 Retrieve current list of object IDs from CollectionSpace, and save them
-in a pickle.
+in a pickle and in the existence index. With --delta, only objects
+created or changed since the last run are fetched and merged in.
 """
 
-import httplib2
+import cspace_client
+import json
+import os
 import pickle
+import time
 from lxml import etree
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
 from csconstants import *
+from cspace_client import shared_client
+from existence_index import ExistenceIndex, build_index, index_exists
+
+NEWEST_FIRST = 'collectionspace_core:updatedAt+DESC'
+
+def fetch_page(client, page, page_size):
+  """Returns the parsed list document for one page of collectionobjects."""
+  print "fetching page %s of objects from Collectionspace." % page
+  resp, content = client.get('collectionobjects?pgNum=%s&pgSz=%s' % (page, page_size))
+  return etree.fromstring(content)
+
+def object_numbers(root):
+  return [oid.text for oid in root.findall('.//objectNumber')]
+
+def list_objects(client, page_size=CSPACE_PAGE_SIZE, workers=1):
+  """
+  Returns every object number in CollectionSpace. The first page says
+  how many items there are; the rest of the pages are then fetched with
+  up to workers requests at once. Duplicates (from records shifting
+  between pages mid-listing) are dropped.
+  """
+  first = fetch_page(client, 0, page_size)
+  total = int(first.find('totalItems').text)
+  pages = (total + page_size - 1) / page_size
+
+  def fetch(page):
+    return object_numbers(fetch_page(client, page, page_size))
+
+  results = [object_numbers(first)]
+  if pages > 1:
+    pool = ThreadPool(max(workers, 1))
+    try:
+      results += pool.map(fetch, range(1, pages))
+    finally:
+      pool.close()
+      pool.join()
 
-if __name__ == "__main__":
   cobjects = []
+  seen = set()
+  for numbers in results:
+    for number in numbers:
+      if not number in seen:
+        seen.add(number)
+        cobjects.append(number)
+  return cobjects
+
+def fetch_recent_page(client, page, page_size):
+  """One page of collectionobjects, most recently updated first."""
+  resp, content = client.get('collectionobjects?pgNum=%s&pgSz=%s&sortBy=%s' %
+    (page, page_size, NEWEST_FIRST))
+  return etree.fromstring(content)
 
-  h = httplib2.Http()
-  h.add_credentials(CSPACE_USER, CSPACE_PASS)
-  resp, content = h.request(CSPACE_URL + 'collectionobjects', 'GET')
+def list_items(root):
+  """(objectNumber, updatedAt) for each item on a page."""
+  items = []
+  for item in root.findall('.//list-item'):
+    items.append((item.findtext('objectNumber'), item.findtext('updatedAt')))
+  return items
 
+def newest_update(client):
+  """The updatedAt of the most recently changed object, or None."""
+  items = list_items(fetch_recent_page(client, 0, 1))
+  if len(items) == 0:
+    return None
+  return items[0][1]
+
+def list_changed_since(client, mark, page_size=CSPACE_PAGE_SIZE):
+  """
+  Returns (object numbers, newest updatedAt) for the objects created or
+  changed at or after mark. Pages are read newest first, stopping at
+  the first item older than mark, once totalItems have been read, or at
+  an empty page. The server may send fewer than page_size a page, so a
+  short page isn't taken as the last.
+  """
+  numbers = []
+  newest = mark
+  page = 0
+  seen = 0
   while True:
-    root = etree.fromstring(content)
-    for oid in root.findall('.//objectNumber'):
-      cobjects.append(oid.text)
-
-    itemcount = root.find('itemsInPage').text
-    if itemcount != '40':
-      # not a full page, must have been the last one
-      break
-    else:
-      page = int(root.find('pageNum').text) + 1
-      print "fetching page %s of objects from Collectionspace." % page
-      resp, content = h.request(
-        CSPACE_URL + 'collectionobjects?pgNum=%s' % page,
-        'GET')
+    print "fetching page %s of recent changes from Collectionspace." % page
+    root = fetch_recent_page(client, page, page_size)
+    items = list_items(root)
+    for number, updated in items:
+      if updated < mark:
+        return numbers, newest
+      if updated > newest:
+        newest = updated
+      numbers.append(number)
+    seen += len(items)
+    total = root.findtext('totalItems')
+    if len(items) == 0 or (total is not None and seen >= int(total)):
+      return numbers, newest
+    page += 1
+
+def load_state(filename=CS_CACHE_STATE_FILE):
+  if not os.path.exists(filename):
+    return {}
+  state_file = open(filename)
+  state = json.load(state_file)
+  state_file.close()
+  return state
+
+def save_state(state, filename=CS_CACHE_STATE_FILE):
+  state_file = open(filename, 'w')
+  json.dump(state, state_file)
+  state_file.close()
+
+def reconcile_due(state, now=None):
+  """Is it time for a full listing? Deletes only show up in one."""
+  if now is None:
+    now = time.time()
+  if state.get('updated_at') is None or not state.has_key('full_listing_at'):
+    return True
+  return now - state['full_listing_at'] > CS_RECONCILE_DAYS * 24 * 60 * 60
+
+def load_cached_objects(filename=CS_OBJECT_FILE):
+  pickle_file = open(filename, 'rb')
+  cobjects = pickle.load(pickle_file)
+  pickle_file.close()
+  return cobjects
+
+def merge_objects(cobjects, new_objects):
+  """Adds the object numbers in new_objects that cobjects lacks, in
+  place. Returns the ones added."""
+  seen = set(cobjects)
+  added = []
+  for number in new_objects:
+    if not number in seen:
+      seen.add(number)
+      cobjects.append(number)
+      added.append(number)
+  return added
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option('-s', '--page-size', dest='page_size', type='int',
+    default=CSPACE_PAGE_SIZE, help="objects per page [default: %default]")
+  parser.add_option('-w', '--workers', dest='workers', type='int',
+    default=CSPACE_POOL_SIZE, help="pages fetched at once [default: %default]")
+  parser.add_option('-d', '--delta', dest='delta', action='store_true',
+    default=False, help="only fetch objects changed since the last run, "
+      "unless a full listing is due")
+  (options, args) = parser.parse_args()
+
+  if options.workers > CSPACE_POOL_SIZE:
+    cspace_client.set_shared_client(
+      cspace_client.CSpaceClient(pool_size=options.workers))
+  client = shared_client()
+  state = load_state()
+
+  if options.delta and not reconcile_due(state) and os.path.exists(CS_OBJECT_FILE) \
+      and index_exists(CS_INDEX_FILE):
+    cobjects = load_cached_objects()
+    changed, state['updated_at'] = list_changed_since(client,
+      state['updated_at'], options.page_size)
+    added = merge_objects(cobjects, changed)
+    index = ExistenceIndex(CS_INDEX_FILE)
+    for number in added:
+      index.add(number)
+    index.close()
+    print "%s objects changed, %s new." % (len(changed), len(added))
+  else:
+    # Take the mark before listing, so anything that changes while the
+    # listing runs is picked up by the next delta.
+    mark = newest_update(client)
+    cobjects = list_objects(client, options.page_size, options.workers)
+    build_index(cobjects, CS_INDEX_FILE)
+    state = {'updated_at': mark, 'full_listing_at': time.time()}
+
+  print "connections: %(connections_opened)s opened, %(connections_reused)s reused" % client.stats()
 
   output = open(CS_OBJECT_FILE, 'wb')
   pickle.dump(cobjects, output)
   output.close()
+  save_state(state)
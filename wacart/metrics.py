@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Run metrics: per-stage counters and latency histograms, periodic
+progress lines with throughput and ETA, and a machine-readable summary
+appended to METRICS_FILE at the end of each run.
+"""
+
+import json
+import threading
+import time
+
+from csconstants import *
+
+# Upper bounds, in seconds, of the latency histogram buckets. Anything
+# slower lands in the last, open-ended bucket.
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0]
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 10.0
+
+def format_duration(seconds):
+  seconds = int(seconds)
+  return "%d:%02d:%02d" % (seconds / 3600, (seconds / 60) % 60, seconds % 60)
+
+class StageStats(object):
+  """Counters and a latency histogram for one stage."""
+
+  def __init__(self):
+    self.count = 0
+    self.failures = 0
+    self.total_time = 0.0
+    self.min_time = None
+    self.max_time = None
+    self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+  def add(self, seconds, count=1, ok=True):
+    self.count += count
+    if not ok:
+      self.failures += count
+    self.total_time += seconds
+    if self.min_time is None or seconds < self.min_time:
+      self.min_time = seconds
+    if self.max_time is None or seconds > self.max_time:
+      self.max_time = seconds
+    i = 0
+    while i < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[i]:
+      i += 1
+    self.buckets[i] += 1
+
+  def as_dict(self):
+    histogram = {}
+    for i in range(len(LATENCY_BUCKETS)):
+      histogram['<=%s' % LATENCY_BUCKETS[i]] = self.buckets[i]
+    histogram['>%s' % LATENCY_BUCKETS[-1]] = self.buckets[-1]
+    return {
+      'count': self.count,
+      'failures': self.failures,
+      'total_time': self.total_time,
+      'min_time': self.min_time,
+      'max_time': self.max_time,
+      'histogram': histogram,
+      }
+
+class Timer(object):
+  """Context manager that records the time spent in its block against
+  a stage. Call fail() inside the block to count it as a failure."""
+
+  def __init__(self, metrics, stage, count):
+    self.metrics = metrics
+    self.stage = stage
+    self.count = count
+    self.ok = True
+
+  def fail(self):
+    self.ok = False
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    ok = self.ok and exc_type is None
+    self.metrics.record(self.stage, time.time() - self.start, self.count, ok)
+    return False
+
+class Metrics(object):
+  """Collects stage statistics for one run of one program. Safe to
+  share between threads."""
+
+  def __init__(self, name, total=None, interval=PROGRESS_INTERVAL):
+    self.name = name
+    self.total = total
+    self.interval = interval
+    self.lock = threading.Lock()
+    self.stages = {}
+    self.counters = {}
+    self.done = 0
+    self.started = time.time()
+    self.last_progress = self.started
+
+  def record(self, stage, seconds, count=1, ok=True):
+    self.lock.acquire()
+    try:
+      if not self.stages.has_key(stage):
+        self.stages[stage] = StageStats()
+      self.stages[stage].add(seconds, count, ok)
+    finally:
+      self.lock.release()
+
+  def timer(self, stage, count=1):
+    return Timer(self, stage, count)
+
+  def timed(self, stage, iterable):
+    """Yields from iterable, recording the time spent waiting on each
+    item against stage."""
+    iterator = iter(iterable)
+    while True:
+      start = time.time()
+      try:
+        item = iterator.next()
+      except StopIteration:
+        return
+      self.record(stage, time.time() - start)
+      yield item
+
+  def count(self, counter, n=1):
+    self.lock.acquire()
+    try:
+      self.counters[counter] = self.counters.get(counter, 0) + n
+    finally:
+      self.lock.release()
+
+  def rate(self):
+    elapsed = time.time() - self.started
+    if elapsed <= 0:
+      return 0.0
+    return self.done / elapsed
+
+  def progress_line(self):
+    rate = self.rate()
+    if self.total is None:
+      return "%s: %s records, %.1f records/sec" % (self.name, self.done, rate)
+    if rate > 0:
+      eta = format_duration((self.total - self.done) / rate)
+    else:
+      eta = '?'
+    return "%s: %s/%s records, %.1f records/sec, ETA %s" % (self.name,
+      self.done, self.total, rate, eta)
+
+  def advance(self, n=1):
+    """Marks n more records as finished, printing a progress line if
+    it's been at least interval seconds since the last one."""
+    self.lock.acquire()
+    try:
+      self.done += n
+      now = time.time()
+      due = now - self.last_progress >= self.interval
+      if due:
+        self.last_progress = now
+    finally:
+      self.lock.release()
+    if due:
+      print self.progress_line()
+
+  def summary(self):
+    self.lock.acquire()
+    try:
+      stages = {}
+      for stage, stats in self.stages.items():
+        stages[stage] = stats.as_dict()
+      return {
+        'name': self.name,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+        'elapsed': time.time() - self.started,
+        'records': self.done,
+        'total': self.total,
+        'records_per_sec': self.rate(),
+        'counters': dict(self.counters),
+        'stages': stages,
+        }
+    finally:
+      self.lock.release()
+
+  def write_summary(self, filename=METRICS_FILE):
+    """Appends this run's summary as one JSON line, so runs can be
+    compared."""
+    output = open(filename, 'a')
+    output.write(json.dumps(self.summary(), sort_keys=True))
+    output.write("\n")
+    output.close()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Resolves WACArt agents (artists, authors, editors) to CollectionSpace
+person authority refNames. The existing terms are fetched once into an
+in-memory index; names that aren't there are created once each, and the
+new refNames kept for the rest of the run.
+"""
+
+import threading
+
+from lxml import etree
+from lxml.builder import E
+from lxml.builder import ElementMaker
+
+from csconstants import *
+from dates import date_group_fields
+
+PERSON_NAMESPACE = 'http://collectionspace.org/services/person'
+
+def display_name(agent):
+  """'First Middle Last' from a guess_name_order style dict."""
+  parts = [agent.get(field) for field in ['first_name', 'middle_name', 'last_name']]
+  return u' '.join([part for part in parts if part])
+
+def name_key(name):
+  """Normalizes a display name for lookups: case and runs of
+  whitespace don't matter."""
+  return u' '.join(name.lower().split())
+
+def person_xml(agent, authority_csid):
+  P = ElementMaker(namespace = PERSON_NAMESPACE,
+                   nsmap = {'ns2': PERSON_NAMESPACE})
+  person = P.persons_common(
+    E.inAuthority(authority_csid),
+    E.displayName(display_name(agent)),
+  )
+  for field, element in [('first_name', 'foreName'), ('middle_name', 'middleName'),
+      ('last_name', 'surName')]:
+    if agent.get(field):
+      person.append(E(element, agent[field]))
+  # Parsed by dates.normalize_dates
+  for field, element in [('birth_date', 'birthDateGroup'), ('death_date', 'deathDateGroup')]:
+    if agent.get(field):
+      person.append(E(element, *date_group_fields(agent[field])))
+  for field, element in [('birth_place', 'birthPlace'), ('sex', 'gender')]:
+    if agent.get(field):
+      person.append(E(element, agent[field]))
+  return etree.tostring(E.document({'name': 'persons'}, person))
+
+class PersonResolver(object):
+  """Safe to share between threads. Concurrent lookups of the same
+  missing name wait on a single create."""
+
+  def __init__(self, client, authority_csid=PERSON_AUTHORITY_CSID,
+               page_size=CSPACE_PAGE_SIZE):
+    self.client = client
+    self.authority_csid = authority_csid
+    self.page_size = page_size
+    self.lock = threading.Lock()
+    self.refnames = {}
+    self.pending = {}
+    # keys of names that couldn't be created, not tried again this run
+    self.unresolvable = set()
+    self.hits = 0
+    self.created = 0
+    self.failed = 0
+
+  def items_path(self):
+    return 'personauthorities/%s/items' % self.authority_csid
+
+  def prefetch(self):
+    """Reads every term in the authority into the index, a page at a
+    time until totalItems have been read or a page comes back empty (the
+    server may send fewer than page_size a page). Returns how many there
+    were."""
+    page = 0
+    seen = 0
+    while True:
+      resp, content = self.client.get('%s?pgNum=%s&pgSz=%s' %
+        (self.items_path(), page, self.page_size))
+      root = etree.fromstring(content)
+      items = root.findall('.//list-item')
+      self.lock.acquire()
+      try:
+        for item in items:
+          name = item.findtext('displayName')
+          refname = item.findtext('refName')
+          if name and refname:
+            self.refnames[name_key(name)] = refname
+      finally:
+        self.lock.release()
+      seen += len(items)
+      total = root.findtext('totalItems')
+      if len(items) == 0 or (total is not None and seen >= int(total)):
+        return len(self.refnames)
+      page += 1
+
+  def create(self, agent):
+    """POSTs a new person, returning its refName, or None on failure."""
+    resp, content = self.client.post_xml(self.items_path(),
+      person_xml(agent, self.authority_csid))
+    if resp['status'] != '201' or not resp.has_key('location'):
+      print "Couldn't create person %s: %s %s" % (display_name(agent).encode('utf-8'),
+        resp['status'], content)
+      return None
+    csid = resp['location'].rstrip('/').split('/')[-1]
+    resp, content = self.client.get('%s/%s' % (self.items_path(), csid))
+    return etree.fromstring(content).findtext('.//refName')
+
+  def resolve(self, agent):
+    """The refName for an agent, creating the person if need be. None if
+    the agent has no name or couldn't be created; a name that couldn't be
+    isn't tried again."""
+    name = display_name(agent)
+    if name == u'':
+      return None
+    key = name_key(name)
+
+    self.lock.acquire()
+    try:
+      if self.refnames.has_key(key):
+        self.hits += 1
+        return self.refnames[key]
+      if key in self.unresolvable:
+        return None
+      waiting_on = self.pending.get(key)
+      if waiting_on is None:
+        self.pending[key] = threading.Event()
+    finally:
+      self.lock.release()
+
+    if waiting_on is not None:
+      waiting_on.wait()
+      return self.refnames.get(key)
+
+    refname = None
+    try:
+      refname = self.create(agent)
+    finally:
+      self.lock.acquire()
+      try:
+        if refname is not None:
+          self.refnames[key] = refname
+          self.created += 1
+        else:
+          self.unresolvable.add(key)
+          self.failed += 1
+        self.pending.pop(key).set()
+      finally:
+        self.lock.release()
+    return refname
+
+  def link_agents(self, record):
+    """Sets 'refName' on each of a record's agents that resolves."""
+    for agent in record.get('agents', []):
+      refname = self.resolve(agent)
+      if refname is not None:
+        agent['refName'] = refname
+
+  def stats(self):
+    return {
+      'person_hits': self.hits,
+      'persons_created': self.created,
+      'person_failures': self.failed,
+      }
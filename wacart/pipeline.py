@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Streams wacart.tab straight into CollectionSpace: parse, prune,
+serialize and POST run at once, each in its own thread(s), joined by
+bounded queues. A slow stage holds back the ones before it rather than
+letting records pile up in memory, and the first inserts go in as soon
+as the first batch is parsed. Run as:
+
+  python pipeline.py [options] [wacart.tab]
+
+wacart.py, list_current_cspace_objects.py and create_cspace_records.py,
+and the files they hand off through, work as before, and are still the
+way to go for debugging a stage on its own. They're also the way to get
+agent demographics filled in from the whole collection (see
+create_cspace_records.build_agent_index), which a stream can't see ahead
+of time.
+"""
+
+import Queue
+import os
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+import create_cspace_records
+import cspace_client
+import list_current_cspace_objects
+import wacart
+from create_cspace_records import imports_document, load_cspace_objectids
+from cspace_client import shared_client
+from dates import normalize_dates
+from dimensions import normalize_dimensions
+from existence_index import ExistenceIndex, index_exists
+from journal import Journal, journaled_successes
+from metrics import Metrics
+from person_authority import PersonResolver
+from records import compact_record
+from report import Report, IMPORT_REPORT_CATEGORIES, IMPORT_SUMMARY_FILE
+from csconstants import *
+
+# Put on a queue after the last item
+DONE = object()
+
+# Seconds between checks, while blocked on a queue, for another stage
+# having failed
+POLL_INTERVAL = 0.5
+
+class Stopped(Exception):
+  """Raised in a stage when another one has failed."""
+
+class Pipeline(object):
+  """
+  parse -> prune -> serialize -> POST. Records are parsed one at a time,
+  or by parse_workers processes a chunk of parse_chunk_size bytes at a
+  time (see wacart.parse_file), and go through the rest in batches of batch_size, with up to workers
+  POSTs in flight at once. existing is anything that supports in and add
+  (see create_cspace_records.load_cspace_objectids), or a callable that
+  returns one, which is called in the prune stage so listing
+  CollectionSpace can overlap the start of the parse. on_result and
+  resolver are as for create_cspace_records.insert_records. Oddities in
+  the parsed records go to parse_report, as wacart.py's do, and
+  dimensions that can't be used go to report.
+  """
+
+  def __init__(self, filename, existing, metrics, batch_size=1, workers=1,
+               parse_workers=1, on_result=None, resolver=None, report=None,
+               tee=None, on_bad=None, parse_report=None,
+               queue_size=PIPELINE_QUEUE_SIZE, parse_chunk_size=wacart.CHUNK_SIZE):
+    self.filename = filename
+    self.existing = existing
+    self.metrics = metrics
+    self.batch_size = batch_size
+    self.workers = workers
+    self.parse_workers = parse_workers
+    self.parse_chunk_size = parse_chunk_size
+    self.on_result = on_result
+    self.resolver = resolver
+    self.report = report
+    self.tee = tee
+    self.on_bad = on_bad
+    self.parse_report = parse_report
+    self.parsed = Queue.Queue(queue_size * batch_size)
+    self.pruned = Queue.Queue(queue_size)
+    self.serialized = Queue.Queue(queue_size)
+    self.stopping = threading.Event()
+    self.errors = []
+    self.lock = threading.Lock()
+    self.created = 0
+    self.first_result = None
+
+  def put(self, queue, item):
+    while True:
+      if self.stopping.is_set():
+        raise Stopped()
+      try:
+        queue.put(item, True, POLL_INTERVAL)
+        return
+      except Queue.Full:
+        pass
+
+  def get(self, queue):
+    while True:
+      if self.stopping.is_set():
+        raise Stopped()
+      try:
+        return queue.get(True, POLL_INTERVAL)
+      except Queue.Empty:
+        pass
+
+  def stage(self, function):
+    """Runs function, stopping the other stages if it fails."""
+    try:
+      function()
+    except Stopped:
+      pass
+    except:
+      self.lock.acquire()
+      try:
+        self.errors.append(sys.exc_info())
+      finally:
+        self.lock.release()
+      self.stopping.set()
+
+  def parse(self):
+    for objekt, agents in self.metrics.timed('parse',
+        wacart.parse_file(self.filename, self.parse_workers,
+          self.parse_chunk_size, self.on_bad)):
+      objekt['agents'] = agents
+      if self.tee is not None:
+        self.tee.write(objekt)
+      if self.parse_report is not None:
+        wacart.note_oddities(objekt, self.parse_report)
+      # No shared strings: they'd outlive the records, which are
+      # dropped once they're POSTed.
+      self.put(self.parsed, compact_record(objekt))
+    self.put(self.parsed, DONE)
+
+  def prune(self):
+    if callable(self.existing):
+      with self.metrics.timer('load'):
+        self.existing = self.existing()
+    batch = []
+    while True:
+      record = self.get(self.parsed)
+      if record is DONE:
+        break
+      if record.get('acc_no') in self.existing:
+        self.metrics.count('pruned')
+        continue
+      batch.append(record)
+      if len(batch) >= self.batch_size:
+        self.put(self.pruned, self.prepare(batch))
+        batch = []
+    if len(batch) > 0:
+      self.put(self.pruned, self.prepare(batch))
+    self.put(self.pruned, DONE)
+
+  def prepare(self, batch):
+    """Normalizes a batch's dates and dimensions. Dates are remembered
+    across batches; dimensions are interned a batch at a time."""
+    with self.metrics.timer('normalize_dates', len(batch)):
+      self.metrics.count('yearless_dates', normalize_dates(batch))
+    with self.metrics.timer('normalize_dimensions', len(batch)):
+      self.metrics.count('dimension_problems',
+        normalize_dimensions(batch, self.report))
+    return batch
+
+  def serialize(self):
+    while True:
+      batch = self.get(self.pruned)
+      if batch is DONE:
+        break
+      if self.resolver is not None:
+        with self.metrics.timer('resolve_agents', len(batch)):
+          for record in batch:
+            self.resolver.link_agents(record)
+      with self.metrics.timer('serialize', len(batch)):
+        object_xml = imports_document(batch)
+      self.put(self.serialized, (batch, object_xml))
+    for i in range(self.workers):
+      self.put(self.serialized, DONE)
+
+  def post(self):
+    while True:
+      item = self.get(self.serialized)
+      if item is DONE:
+        return
+      batch, object_xml = item
+      results = create_cspace_records.post_batch(batch, self.metrics, object_xml)
+      self.lock.acquire()
+      try:
+        if self.first_result is None:
+          self.first_result = time.time() - self.metrics.started
+          print "first records in after %.1f seconds" % self.first_result
+        self.created += sum(results)
+      finally:
+        self.lock.release()
+      if self.on_result is not None:
+        for record, result in zip(batch, results):
+          self.on_result(record, result)
+      self.metrics.advance(len(batch))
+
+  def run(self):
+    """Runs every stage to the end, returning the number of records
+    created. If a stage fails, the rest are stopped and its exception
+    raised here."""
+    threads = [threading.Thread(target=self.stage, args=(function,))
+      for function in [self.parse, self.prune, self.serialize]]
+    threads += [threading.Thread(target=self.stage, args=(self.post,))
+      for i in range(self.workers)]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    try:
+      for thread in threads:
+        while thread.is_alive():
+          thread.join(POLL_INTERVAL)
+    except KeyboardInterrupt:
+      self.stopping.set()
+      raise
+    if len(self.errors) > 0:
+      exc_type, exc_value, traceback = self.errors[0]
+      raise exc_type, exc_value, traceback
+    if self.first_result is not None:
+      self.metrics.record('first_result', self.first_result)
+    return self.created
+
+def list_existing():
+  """The object numbers already in CollectionSpace: the existence index
+  or pickle list_current_cspace_objects.py left, if there is one,
+  otherwise a fresh listing."""
+  if index_exists(CS_INDEX_FILE) or os.path.exists(CS_OBJECT_FILE):
+    return load_cspace_objectids()
+  print "no saved listing, listing CollectionSpace"
+  return set(list_current_cspace_objects.list_objects(shared_client(),
+    CSPACE_PAGE_SIZE, CSPACE_POOL_SIZE))
+
+if __name__ == "__main__":
+  parser = OptionParser(usage="%prog [options] [wacart.tab]")
+  parser.add_option('-j', '--parse-workers', dest='parse_workers', type='int',
+    default=1, help="processes to parse with [default: %default]")
+  parser.add_option('-b', '--batch-size', dest='batch_size', type='int',
+    default=1, help="records per imports POST [default: %default]")
+  parser.add_option('-w', '--workers', dest='workers', type='int',
+    default=1, help="imports POSTs in flight at once [default: %default]")
+  parser.add_option('-a', '--link-agents', dest='link_agents',
+    action='store_true', default=False,
+    help="find or create a person authority term for each agent and link "
+      "it to the object (needs PERSON_AUTHORITY_CSID)")
+  parser.add_option('-r', '--resume', dest='resume', action='store_true',
+    default=False, help="skip records %s says were already created, and "
+      "append to it rather than starting it over" % IMPORT_JOURNAL_FILE)
+  parser.add_option('-t', '--tee', dest='tee', action='store_true',
+    default=False, help="also write the parsed records to %s, as wacart.py "
+      "would" % WAC_OBJECTS_FILE)
+  (options, args) = parser.parse_args()
+  if len(args) > 1:
+    parser.error("only one export file, please")
+  filename = 'wacart.tab'
+  if len(args) == 1:
+    filename = args[0]
+
+  if options.workers > CSPACE_POOL_SIZE:
+    cspace_client.set_shared_client(
+      cspace_client.CSpaceClient(pool_size=options.workers))
+
+  metrics = Metrics('pipeline')
+
+  resolver = None
+  if options.link_agents:
+    if PERSON_AUTHORITY_CSID == '':
+      parser.error("--link-agents needs PERSON_AUTHORITY_CSID set in csconstants.py")
+    resolver = PersonResolver(shared_client())
+    with metrics.timer('prefetch_persons'):
+      print "%s person authority terms loaded" % resolver.prefetch()
+
+  existing_cspace_records = []
+
+  def load_existing():
+    existing = list_existing()
+    if options.resume:
+      for acc_no in journaled_successes(IMPORT_JOURNAL_FILE):
+        existing.add(acc_no)
+    existing_cspace_records.append(existing)
+    return existing
+
+  journal = Journal(IMPORT_JOURNAL_FILE, append=options.resume)
+
+  def note_result(record, result):
+    journal.note(record['acc_no'], result)
+    if result:
+      existing_cspace_records[0].add(record['acc_no'])
+
+  badlines = open('badlines.log', 'w')
+
+  def note_bad_record(piece):
+    badlines.write(piece.encode('utf-8') + "\n")
+    metrics.count('bad_records')
+
+  tee = None
+  if options.tee:
+    tee = wacart.JsonLinesWriter(WAC_OBJECTS_FILE)
+  parse_report = Report()
+  report = Report(categories=IMPORT_REPORT_CATEGORIES,
+    summary_file=IMPORT_SUMMARY_FILE)
+
+  pipeline = Pipeline(filename, load_existing, metrics, options.batch_size,
+    options.workers, options.parse_workers, note_result, resolver, report,
+    tee, note_bad_record, parse_report)
+  try:
+    total_records_created = pipeline.run()
+  finally:
+    journal.close()
+    badlines.close()
+    counts = parse_report.close()
+    report.close()
+    if tee is not None:
+      tee.close()
+    if len(existing_cspace_records) > 0 and isinstance(existing_cspace_records[0], ExistenceIndex):
+      existing_cspace_records[0].close()
+
+  metrics.count('created', total_records_created)
+  for counter, value in shared_client().stats().items():
+    metrics.count(counter, value)
+  if resolver is not None:
+    for counter, value in resolver.stats().items():
+      metrics.count(counter, value)
+  for counter, value in wacart.name_cache_stats().items():
+    metrics.count(counter, value)
+  print metrics.progress_line()
+  metrics.write_summary()
+  print "All records processed. Created %s new records.\n" % total_records_created
+  print "Data-quality report:"
+  for category in sorted(counts.keys()):
+    print "  %s: %s" % (category, counts[category])
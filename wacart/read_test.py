@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 # vim: set fileencoding=utf-8 :
 
+import multiprocessing.pool
+import os
+import re
+import shutil
+import tempfile
+import report
+import staging
 import wacart
 import unittest
 
@@ -131,6 +138,44 @@ class ObjectStuff(unittest.TestCase):
     agentstring6 = 'von Mies, Tomma'
     self.assertEqual("von Mies, Tomma", wacart.unpack_agent_names(agentstring6)[0])
 
+  def testSanitizeForXml(self):
+    """control characters XML can't carry, and repeat characters in
+    fields that don't repeat, shouldn't make it out of the parse"""
+
+    dirty = mockExport({'acc_no': '2011.\x07404\x1d', 'title': 'foo\x0b\x01bar',
+      'dimensions': '12\x0bby 14', 'creator_text_inverted': 'Doe, John & Co'})
+    objekt, agents = wacart.parse_line(dirty)
+    self.assertEqual('2011.404', objekt['acc_no'])
+    self.assertEqual(['foo', 'bar'], objekt['title'])
+    self.assertEqual('12 by 14', objekt['dimensions'])
+    self.assertEqual('Doe, John & Co', objekt['creator_text_inverted'])
+
+  def testNameParsingCached(self):
+    """repeated names come from the cache, as copies callers can
+    change"""
+    before = wacart.name_cache_stats()
+    first = wacart.guess_name_order(u'Cachington, Bob Q')
+    first['born'] = '1900'
+    second = wacart.guess_name_order(u'Cachington, Bob Q')
+    self.assertFalse(second.has_key('born'))
+    self.assertEqual('Q', second['middle_name'])
+    names = wacart.unpack_agent_names(u'Cachington, Bob; Smith, Al')
+    names.append('junk')
+    self.assertEqual(2, len(wacart.unpack_agent_names(u'Cachington, Bob; Smith, Al')))
+    after = wacart.name_cache_stats()
+    self.assertEqual(1, after['guess_name_order_cache_hits'] - before['guess_name_order_cache_hits'])
+    self.assertEqual(1, after['unpack_agent_names_cache_misses'] - before['unpack_agent_names_cache_misses'])
+
+  def testLRUCacheBounded(self):
+    cache = wacart.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    self.assertEqual(None, cache.get('b'))
+    self.assertEqual(1, cache.get('a'))
+    self.assertEqual({'hits': 2, 'misses': 1}, cache.stats())
+
   def testStripUnicode(self):
     self.assertEqual('foo', wacart.strip_spaces(u' foo '))
 
@@ -206,5 +251,247 @@ class ObjectStuff(unittest.TestCase):
     self.assertEqual("von Smith", wacart.guess_name_order(namestring7)['last_name'])
     self.assertEqual("Bob", wacart.guess_name_order(namestring7)['first_name'])
 
+def legacySplitRepeats(value):
+  """break_out_multiple_objects as it was before split_repeats, to check
+  the single-pass splitter against."""
+  def just_space(field):
+    return re.search(r'^\s*$', field) is not None
+
+  def break_on_delimeter(string, delimiter):
+    if string.find(delimiter) > -1:
+      return_values = [v for v in string.split(delimiter) if not just_space(v)]
+      if len(return_values) == 1:
+        return return_values[0]
+      return return_values
+    return [string]
+
+  for delimiter in ["\x0b", "\x1d"]:
+    if type(value) != type([]):
+      value = break_on_delimeter(value, delimiter)
+    else:
+      accumulator = []
+      for item in value:
+        accumulator += break_on_delimeter(item, delimiter)
+      value = accumulator
+  if type(value) != type([]):
+    value = [ value ]
+  return value
+
+class RepeatStuff(unittest.TestCase):
+
+  def testMatchesLegacySplitting(self):
+    for value in [u'foo', u' foo ', u'foo\x0b', u'foo\x0bbar', u'foo\x1dbar',
+        u'foo\x0b\x0b bar\x0b ', u'great!\x0bbad.', u'a\x1db\x1dc',
+        u'12 in.\x1d30.5 cm\x0b4 in.\x1d10 cm', u' \x0b ', u'\x1d\x1dx',
+        u'Tom\xe9e\x0bSans titre']:
+      self.assertEqual(legacySplitRepeats(value), wacart.split_repeats(value))
+
+  def testMixedDelimitersNoLongerSplitIntoCharacters(self):
+    # The old splitter added a lone second-pass value to its list as a
+    # string, character by character.
+    self.assertEqual(['a', 'b', 'c'], legacySplitRepeats(u'a\x0bbc\x1d '))
+    self.assertEqual(['a', 'bc'], wacart.split_repeats(u'a\x0bbc\x1d '))
+
+class OutputStuff(unittest.TestCase):
+
+  def setUp(self):
+    handle, self.filename = tempfile.mkstemp()
+    os.close(handle)
+    self.records = [
+      {'acc_no': '2011.404', 'title': [u'J\xfcrgen'], 'agents': []},
+      {'acc_no': '2011.405', 'agents': [{'last_name': 'Bob'}]},
+      ]
+
+  def tearDown(self):
+    os.remove(self.filename)
+
+  def testJsonLinesRoundTrip(self):
+    output = wacart.JsonLinesWriter(self.filename)
+    for record in self.records:
+      output.write(record)
+    # Should be readable before the writer is closed
+    self.assertEqual(self.records, list(wacart.read_objects(self.filename)))
+    output.close()
+    self.assertEqual(2, len(open(self.filename).readlines()))
+
+  def testJsonArrayRoundTrip(self):
+    output = wacart.JsonArrayWriter(self.filename)
+    for record in self.records:
+      output.write(record)
+    output.close()
+    self.assertEqual(self.records, list(wacart.read_objects(self.filename)))
+
+  def testEmptyArray(self):
+    wacart.JsonArrayWriter(self.filename).close()
+    self.assertEqual([], list(wacart.read_objects(self.filename)))
+
+class StagingStuff(unittest.TestCase):
+
+  def setUp(self):
+    handle, self.filename = tempfile.mkstemp()
+    os.close(handle)
+
+  def tearDown(self):
+    os.remove(self.filename)
+
+  def testStageSelectAndStatus(self):
+    store = wacart.OUTPUT_WRITERS['sqlite'](self.filename)
+    for acc_no, classification in [('2003.1', 'Print'), ('2003.2', 'Painting'),
+        ('2004.1', 'Print')]:
+      objekt, agents = wacart.parse_line(mockExport({'acc_no': acc_no,
+        'classification': classification, 'title': u'Tom\x8ee'.encode('latin-1'),
+        'creator_text_inverted': 'Doe, John; Roe, Jane'}))
+      objekt['agents'] = agents
+      store.write(objekt)
+    store.close()
+
+    store = staging.StagingStore(self.filename)
+    prints = list(store.select(classification='Print'))
+    self.assertEqual(['2003.1', '2004.1'], [r['acc_no'] for r in prints])
+    self.assertEqual([u'Tom\xe9e'], prints[0]['title'])
+    self.assertEqual(['2003.1', '2003.2'],
+      [r['acc_no'] for r in store.select(acc_no_prefix='2003.')])
+    self.assertEqual(u'Doe, John', staging.first_artist(prints[0]))
+
+    store.set_status('2003.2', 'created')
+    self.assertEqual(['2003.1', '2004.1'],
+      [r['acc_no'] for r in store.select(status='none')])
+    self.assertEqual({None: 2, 'created': 1}, store.status_counts())
+    store.close()
+
+    store = wacart.OUTPUT_WRITERS['sqlite'](self.filename)
+    self.assertEqual([], list(store.select()))
+    store.close()
+
+class ReportStuff(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testOdditiesAreStructuredAndCounted(self):
+    objekt, agents = wacart.parse_line(mockExport({'object_id': '42',
+      'creator_text_inverted': 'Doe, John', 'running_time': '2 hours',
+      'frame': 'maybe', 'ethnicity': '1900'}))
+    objekt['agents'] = agents
+    rows = wacart.find_oddities(objekt)
+    self.assertTrue(('runtime', '42', '2 hours') in rows)
+    self.assertTrue(('frame', '42', ['maybe']) in rows)
+
+    sink = report.Report(self.directory)
+    wacart.note_oddities(objekt, sink)
+    wacart.note_oddities(objekt, sink)
+    counts = sink.close()
+    self.assertEqual(2, counts['runtime'])
+    self.assertEqual(0, counts['editors'])
+    lines = open(os.path.join(self.directory, 'runtime.log')).readlines()
+    self.assertEqual("runtime\t42\t2 hours\r\n", lines[0])
+    self.assertTrue(os.path.exists(os.path.join(self.directory, report.SUMMARY_FILE)))
+
+class ParallelStuff(unittest.TestCase):
+
+  def setUp(self):
+    handle, self.filename = tempfile.mkstemp()
+    tabfile = os.fdopen(handle, 'wb')
+    for i in range(50):
+      tabfile.write(mockExport({'title': 'foo %s\x0bbar' % i,
+        'acc_no': '2011.%s' % i, 'creator_text_inverted': 'Doe, John; Roe, Jane',
+        'born': '1900/1998'}) + "\n")
+    tabfile.close()
+
+  def tearDown(self):
+    os.remove(self.filename)
+
+  def testChunksCoverFileOnLineBoundaries(self):
+    offsets = wacart.chunk_offsets(self.filename, 500)
+    self.assertEqual(0, offsets[0][0])
+    self.assertEqual(os.path.getsize(self.filename), offsets[-1][1])
+    data = open(self.filename, 'rb').read()
+    for start, end in offsets:
+      self.assertEqual("\n", data[end - 1])
+
+  def testParallelMatchesSerial(self):
+    serial = list(wacart.parse_file(self.filename))
+    parallel = list(wacart.parse_file(self.filename, workers=3, chunk_size=500))
+    self.assertEqual(50, len(serial))
+    self.assertEqual(serial, parallel)
+
+  def testChunksInFlightBounded(self):
+    submitted = []
+    class CountingPool(multiprocessing.pool.Pool):
+      def apply_async(self, function, args=(), kwds={}, callback=None):
+        submitted.append(args)
+        return multiprocessing.pool.Pool.apply_async(self, function, args, kwds, callback)
+    chunks = len(wacart.chunk_offsets(self.filename, 500))
+    real_pool = wacart.Pool
+    wacart.Pool = CountingPool
+    try:
+      records = wacart.parse_file(self.filename, workers=2, chunk_size=500)
+      records.next()
+      self.assertEqual(2 * wacart.CHUNKS_IN_FLIGHT + 1, len(submitted))
+      self.assertTrue(len(submitted) < chunks)
+      self.assertEqual(49, len(list(records)))
+      self.assertEqual(chunks, len(submitted))
+    finally:
+      wacart.Pool = real_pool
+
+class ReassemblyStuff(unittest.TestCase):
+
+  def setUp(self):
+    handle, self.filename = tempfile.mkstemp()
+    tabfile = os.fdopen(handle, 'wb')
+    for i in range(30):
+      location = 'Gallery %s' % i
+      if i % 3 == 0:
+        location = 'Gallery %s\nby the \xa5 stairs\n' % i
+      condition = 'good'
+      if i % 4 == 0:
+        # a newline in the first column leaves a whole record's worth
+        # of tabs on the line after it
+        condition = 'fair\nstable'
+      tabfile.write(mockExport({'acc_no': '2011.%s' % i, 'condition': condition,
+        'related_material_location': location, 'title': 'foo',
+        'creator_text_inverted': 'Doe, John'}) + "\n")
+      if i == 10:
+        tabfile.write("\ttruncated\tby hand\n\n")
+    tabfile.close()
+
+  def tearDown(self):
+    os.remove(self.filename)
+
+  def testEmbeddedNewlinesRejoined(self):
+    bad = []
+    records = list(wacart.read_records(self.filename, bad.append, block_size=64))
+    self.assertEqual(30, len(records))
+    self.assertEqual([u'\ttruncated\tby hand\n'], bad)
+    objekt, agents = wacart.parse_record(records[3])
+    self.assertEqual(u'2011.3', objekt['acc_no'])
+    self.assertEqual(u'Gallery 3\nby the \u2022 stairs', objekt['related_material_location'])
+
+  def testBlockSizeDoesNotMatter(self):
+    small = list(wacart.read_records(self.filename, block_size=7))
+    large = list(wacart.read_records(self.filename))
+    self.assertEqual(large, small)
+
+  def testSameAsParseLine(self):
+    line = mockExport({'acc_no': '2011.1', 'title': 'Caf\x8e',
+      'creator_text_inverted': 'Doe, John'})
+    self.assertEqual(wacart.parse_line(line),
+      wacart.parse_record(list(wacart.assemble_records([line.decode('mac-roman')]))[0]))
+
+  def testParallelMatchesSerial(self):
+    bad = []
+    serial = list(wacart.parse_file(self.filename, on_bad=bad.append))
+    parallel_bad = []
+    parallel = list(wacart.parse_file(self.filename, workers=3, chunk_size=200,
+      on_bad=parallel_bad.append))
+    self.assertEqual(30, len(serial))
+    self.assertEqual([u'fair\nstable'], serial[4][0]['condition'])
+    self.assertEqual(serial, parallel)
+    self.assertEqual(bad, parallel_bad)
+    self.assertTrue(len(wacart.chunk_offsets(self.filename, 200)) > 3)
+
 if __name__ == "__main__":
     unittest.main()   
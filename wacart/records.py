@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Compact types for parsed WACArt records, for holding a whole collection
+in memory. They answer the dict calls the importer makes (has_key, get,
+[], keys, ...), and convert to and from the plain dicts that wacart.py
+writes as JSON without losing anything.
+"""
+
+from wacart import COLUMNS
+
+COLUMN_INDEX = dict([(COLUMNS[i]['name'], i) for i in range(len(COLUMNS))])
+
+MISSING = object()
+
+# Record fields with few distinct values, which compact_record can share
+# one copy of between records. Agent values are always shared; the same
+# people turn up all over the collection.
+SHARED_FIELDS = set(['classification', 'status', 'credit_line', 'medium',
+  'support', 'genre', 'iaia_style', 'iaia_subject', 'frame', 'unique_frame',
+  'media', 'binding', 'source', 'printer', 'publisher', 'fabricator',
+  'foundry', 'date', 'born', 'died', 'sex', 'ethnicity', 'nationality',
+  'birth_place', 'mnartist', 'creator_text_inverted', 'author', 'editor'])
+
+def share(value, shared):
+  """The copy of a string (or each of a list of strings) in shared,
+  adding it if it isn't there yet."""
+  if type(value) == type([]):
+    return [share(item, shared) for item in value]
+  if isinstance(value, basestring):
+    return shared.setdefault(value, value)
+  return value
+
+class DictLike(object):
+  """The parts of the dict interface built on keys() and get()."""
+  __slots__ = []
+
+  def has_key(self, key):
+    return self.get(key, MISSING) is not MISSING
+
+  __contains__ = has_key
+
+  def __getitem__(self, key):
+    value = self.get(key, MISSING)
+    if value is MISSING:
+      raise KeyError(key)
+    return value
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self.keys())
+
+  def items(self):
+    return [(key, self[key]) for key in self.keys()]
+
+  def __eq__(self, other):
+    return dict(self.items()) == dict(other.items())
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return '%s(%r)' % (self.__class__.__name__, self.to_dict())
+
+class WacartObject(DictLike):
+  """
+  A parsed record. Fields from COLUMNS are kept in a list holding only
+  the fields that are present, in column order, with a bitmask of which
+  columns those are. Anything else (agents aside) goes in a dict that
+  only exists if it's needed.
+  """
+  __slots__ = ['present', 'values', 'agents', 'extra']
+
+  def __init__(self):
+    self.present = 0
+    self.values = []
+    self.agents = None
+    self.extra = None
+
+  def position(self, column):
+    """Where column's value is, or would go, in values."""
+    return bin(self.present & ((1 << column) - 1)).count('1')
+
+  def get(self, key, default=None):
+    if key == 'agents':
+      if self.agents is None:
+        return default
+      return self.agents
+    column = COLUMN_INDEX.get(key)
+    if column is None:
+      if self.extra is None:
+        return default
+      return self.extra.get(key, default)
+    if not self.present & (1 << column):
+      return default
+    return self.values[self.position(column)]
+
+  def __setitem__(self, key, value):
+    if key == 'agents':
+      self.agents = [compact_agent(agent) for agent in value]
+      return
+    column = COLUMN_INDEX.get(key)
+    if column is None:
+      if self.extra is None:
+        self.extra = {}
+      self.extra[key] = value
+    elif self.present & (1 << column):
+      self.values[self.position(column)] = value
+    else:
+      self.values.insert(self.position(column), value)
+      self.present |= 1 << column
+
+  def __delitem__(self, key):
+    if key == 'agents' and self.agents is not None:
+      self.agents = None
+      return
+    column = COLUMN_INDEX.get(key)
+    if column is None:
+      if self.extra is None or not self.extra.has_key(key):
+        raise KeyError(key)
+      del self.extra[key]
+    elif self.present & (1 << column):
+      del self.values[self.position(column)]
+      self.present &= ~(1 << column)
+    else:
+      raise KeyError(key)
+
+  def keys(self):
+    keys = [COLUMNS[i]['name'] for i in range(len(COLUMNS)) if self.present & (1 << i)]
+    if self.agents is not None:
+      keys.append('agents')
+    if self.extra is not None:
+      keys += self.extra.keys()
+    return keys
+
+  def to_dict(self):
+    record = {}
+    for key in self.keys():
+      record[key] = self.get(key)
+    if self.agents is not None:
+      record['agents'] = [agent.to_dict() for agent in self.agents]
+    return record
+
+class Agent(DictLike):
+  """An artist, author or editor, as made by wacart.break_out_agents."""
+  FIELDS = ['first_name', 'middle_name', 'last_name', 'agent_type', 'born',
+    'died', 'birth_place', 'sex', 'ethnicity', 'nationality',
+    'author_birth_place', 'author_gender', 'author_death_year',
+    'author_nationality', 'refName', 'birth_date', 'death_date']
+  __slots__ = FIELDS + ['extra']
+
+  def __init__(self):
+    self.extra = None
+
+  def get(self, key, default=None):
+    if key in Agent.FIELDS:
+      return getattr(self, key, default)
+    if self.extra is None:
+      return default
+    return self.extra.get(key, default)
+
+  def __setitem__(self, key, value):
+    if key in Agent.FIELDS:
+      setattr(self, key, value)
+    else:
+      if self.extra is None:
+        self.extra = {}
+      self.extra[key] = value
+
+  def __delitem__(self, key):
+    if not self.has_key(key):
+      raise KeyError(key)
+    if key in Agent.FIELDS:
+      delattr(self, key)
+    else:
+      del self.extra[key]
+
+  def keys(self):
+    keys = [field for field in Agent.FIELDS if hasattr(self, field)]
+    if self.extra is not None:
+      keys += self.extra.keys()
+    return keys
+
+  def to_dict(self):
+    return dict(self.items())
+
+def compact_agent(agent, shared=None):
+  """An Agent holding the same things as an agent dict. See
+  compact_record for shared."""
+  if isinstance(agent, Agent):
+    return agent
+  compact = Agent()
+  for key, value in agent.items():
+    if shared is not None:
+      value = share(value, shared)
+    compact[key] = value
+  return compact
+
+def compact_record(record, shared=None):
+  """
+  A WacartObject holding the same things as a parsed record dict. If
+  shared is given, it's a dict that strings repeated between records are
+  kept one copy of; use one per batch of records loaded together, and
+  let it go with them.
+  """
+  if isinstance(record, WacartObject):
+    return record
+  compact = WacartObject()
+  for key, value in record.items():
+    if key == 'agents':
+      value = [compact_agent(agent, shared) for agent in value]
+    elif shared is not None and key in SHARED_FIELDS:
+      value = share(value, shared)
+    compact[key] = value
+  return compact
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Data-quality report for a parse run. Each category of oddity gets its
+own tab-separated file of (category, object_id, value) rows, opened
+once per run, plus a count summary at the end.
+"""
+
+import csv
+import json
+import os
+import threading
+
+# category -> file the rows are written to
+REPORT_CATEGORIES = {
+  'runtime': 'runtime.log',
+  'frame': 'frame.log',
+  'ethnicity': 'ethnicity.log',
+  'agents': 'agents.log',
+  'editors': 'editors.log',
+  }
+SUMMARY_FILE = 'report_summary.log'
+
+# The same, for create_cspace_records.py
+IMPORT_REPORT_CATEGORIES = {
+  'dimensions': 'dimensions.log',
+  }
+IMPORT_SUMMARY_FILE = 'import_report_summary.log'
+BUFFER_SIZE = 64 * 1024
+
+def cell(value):
+  """Flattens a value into something csv can write."""
+  if value is None:
+    return ''
+  if not isinstance(value, basestring):
+    value = json.dumps(value, ensure_ascii=False)
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  return value
+
+class Report(object):
+  """Sink for data-quality rows. Safe to share between threads. A
+  parallel parse feeds one Report from the parent process as the merged
+  results come back, so the rows stay in input order."""
+
+  def __init__(self, directory='.', categories=REPORT_CATEGORIES,
+               summary_file=SUMMARY_FILE):
+    self.directory = directory
+    self.summary_file = summary_file
+    self.lock = threading.Lock()
+    self.counts = {}
+    self.handles = {}
+    self.writers = {}
+    for category, filename in categories.items():
+      handle = open(os.path.join(directory, filename), 'wb', BUFFER_SIZE)
+      self.handles[category] = handle
+      self.writers[category] = csv.writer(handle, dialect='excel-tab')
+      self.counts[category] = 0
+
+  def note(self, category, object_id, value):
+    row = [cell(category), cell(object_id), cell(value)]
+    self.lock.acquire()
+    try:
+      self.writers[category].writerow(row)
+      self.counts[category] += 1
+    finally:
+      self.lock.release()
+
+  def summary(self):
+    """Returns a dict of category -> number of rows noted."""
+    self.lock.acquire()
+    try:
+      return dict(self.counts)
+    finally:
+      self.lock.release()
+
+  def close(self):
+    """Flushes and closes the sinks, writes the count summary, and
+    returns it."""
+    counts = self.summary()
+    for handle in self.handles.values():
+      handle.close()
+    output = open(os.path.join(self.directory, self.summary_file), 'w')
+    for category in sorted(counts.keys()):
+      output.write("%s: %s\n" % (category, counts[category]))
+    output.close()
+    return counts
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+SQLite staging store for parsed WACArt records. Each record is kept
+whole as a JSON blob, with indexed columns for the fields the importer
+selects on, and a per-record import status.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from csconstants import *
+
+SCHEMA = [
+  """CREATE TABLE IF NOT EXISTS records (
+       seq INTEGER PRIMARY KEY,
+       acc_no TEXT,
+       object_id TEXT,
+       classification TEXT,
+       first_artist TEXT,
+       record BLOB NOT NULL,
+       status TEXT,
+       status_at REAL
+     )""",
+  "CREATE INDEX IF NOT EXISTS records_acc_no ON records (acc_no)",
+  "CREATE INDEX IF NOT EXISTS records_object_id ON records (object_id)",
+  "CREATE INDEX IF NOT EXISTS records_classification ON records (classification)",
+  "CREATE INDEX IF NOT EXISTS records_first_artist ON records (first_artist)",
+  ]
+
+# Rows written per transaction while staging a parse
+COMMIT_EVERY = 1000
+
+def first_artist(objekt):
+  """'Last, First' for the first artist agent of a parsed record."""
+  for agent in objekt.get('agents', []):
+    if agent.get('agent_type') == 'artist':
+      if agent.has_key('first_name'):
+        return u"%s, %s" % (agent.get('last_name', u''), agent['first_name'])
+      return agent.get('last_name')
+  return None
+
+def scalar(value):
+  if type(value) == type([]):
+    if len(value) == 0:
+      return None
+    return value[0]
+  return value
+
+class StagingStore(object):
+  """
+  Can be used as one of wacart.OUTPUT_WRITERS (write/close) to stage a
+  parse, and by the importer to select records and note how their
+  import went. Safe to share between threads.
+  """
+
+  def __init__(self, filename=WAC_STAGING_FILE, fresh=False):
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    if fresh:
+      self.db.execute("DROP TABLE IF EXISTS records")
+    for statement in SCHEMA:
+      self.db.execute(statement)
+    self.db.commit()
+    self.pending = 0
+
+  def write(self, objekt):
+    blob = json.dumps(objekt, ensure_ascii=False).encode('utf-8')
+    self.lock.acquire()
+    try:
+      self.db.execute("""INSERT INTO records
+        (acc_no, object_id, classification, first_artist, record)
+        VALUES (?, ?, ?, ?, ?)""", (objekt.get('acc_no'),
+        objekt.get('object_id'), scalar(objekt.get('classification')),
+        first_artist(objekt), buffer(blob)))
+      self.pending += 1
+      if self.pending >= COMMIT_EVERY:
+        self.db.commit()
+        self.pending = 0
+    finally:
+      self.lock.release()
+
+  def select(self, classification=None, acc_no_prefix=None, status=None):
+    """Yields staged records, in the order they were written, matching
+    every criterion given. A status of 'none' matches records that
+    haven't been tried."""
+    where = []
+    args = []
+    if classification is not None:
+      where.append("classification = ?")
+      args.append(classification)
+    if acc_no_prefix is not None:
+      where.append("substr(acc_no, 1, ?) = ?")
+      args += [len(acc_no_prefix), acc_no_prefix]
+    if status == 'none':
+      where.append("status IS NULL")
+    elif status is not None:
+      where.append("status = ?")
+      args.append(status)
+    query = "SELECT record FROM records"
+    if len(where) > 0:
+      query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY seq"
+
+    self.lock.acquire()
+    try:
+      rows = self.db.execute(query, args).fetchall()
+    finally:
+      self.lock.release()
+    for row in rows:
+      yield json.loads(str(row[0]).decode('utf-8'))
+
+  def set_status(self, acc_no, status):
+    self.lock.acquire()
+    try:
+      self.db.execute("UPDATE records SET status = ?, status_at = ? WHERE acc_no = ?",
+        (status, time.time(), acc_no))
+      self.db.commit()
+    finally:
+      self.lock.release()
+
+  def status_counts(self):
+    self.lock.acquire()
+    try:
+      rows = self.db.execute(
+        "SELECT status, count(*) FROM records GROUP BY status").fetchall()
+    finally:
+      self.lock.release()
+    return dict(rows)
+
+  def close(self):
+    self.lock.acquire()
+    try:
+      self.db.commit()
+      self.db.close()
+    finally:
+      self.lock.release()
+
+def new_staging_store(filename=WAC_STAGING_FILE):
+  """An empty store at filename, replacing anything staged there."""
+  return StagingStore(filename, fresh=True)
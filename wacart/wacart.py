@@ -9,11 +9,34 @@ structures thereof.
 
 import codecs
 import json
+import mmap
+import os
 import re
+import threading
+from collections import OrderedDict, deque
+from multiprocessing import Pool
+from optparse import OptionParser
 from csconstants import *
+from metrics import Metrics
+from report import Report
+from staging import new_staging_store
 
 NAME_DELIMITERS = [';', ' and ']
 
+# Bytes of wacart.tab handed to each worker in a parallel parse.
+CHUNK_SIZE = 1024 * 1024
+
+# Chunks per worker submitted to the pool ahead of the one being
+# consumed. More just pile up, parsed, in memory when the consumer is
+# slow.
+CHUNKS_IN_FLIGHT = 2
+
+# Bytes of wacart.tab decoded at a time.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Distinct name strings remembered by each of the name parsing caches.
+NAME_CACHE_SIZE = 20000
+
 # order important! Must match input.
 COLUMNS = [
   {'name':  "condition", 'repeat': True},
@@ -89,6 +112,44 @@ COLUMNS = [
   {'name':  'reproduction_rights'}
  ]
 
+# Tabs in a complete record, wherever its newlines fall.
+RECORD_TABS = len(COLUMNS) - 1
+
+# Characters matched by \s in the (non-unicode) regexes this module
+# used to strip with. unicode.strip() with no argument would also eat
+# the FileMaker repeat characters and mac-roman non-breaking spaces.
+WHITESPACE = ' \t\n\r\f\v'
+
+HAS_WORD_CHARACTER = re.compile(r'\w')
+
+# FileMaker's repeating-field delimiters. Both are control characters
+# that XML won't accept, so any left over after splitting have to go.
+REPEAT_MARKERS = u'\x0b\x1d'
+
+# The rest of the control characters XML 1.0 doesn't allow, for
+# unicode.translate. Applied to each line as it's decoded.
+INVALID_XML_TABLE = dict([(c, None) for c in range(0x20)
+  if unichr(c) not in u'\t\n\r' + REPEAT_MARKERS])
+
+# unicode.translate is slow in Python 2, so only lines that need it go
+# through it.
+HAS_INVALID_XML = re.compile(u'[%s]' % u''.join([unichr(c) for c in sorted(INVALID_XML_TABLE.keys())]))
+
+# Stray repeat markers in fields that don't repeat become spaces.
+REPEAT_MARKER_TABLE = dict([(ord(c), u' ') for c in REPEAT_MARKERS])
+
+def compile_columns(columns):
+  """Turns a COLUMNS-style list into a list of (index, name, repeat,
+  cleaner) tuples, so that parse_line doesn't have to look anything up
+  per field."""
+  plan = []
+  for i in range(len(columns)):
+    if columns[i].has_key('repeat'):
+      plan.append((i, columns[i]['name'], True, split_repeats))
+    else:
+      plan.append((i, columns[i]['name'], False, clean_scalar))
+  return plan
+
 def parse_line(line):
   """Parses a FileMaker export of the WACArt database, returning one
   dict for the object, one for the related agent(s).
@@ -97,69 +158,46 @@ def parse_line(line):
   # 
   # FileMaker gives us OS 9-era output.
   #
-  line = line.decode('mac-roman')
+  return parse_record(line.decode('mac-roman'))
+
+def parse_record(record):
+  """parse_line for a record that's already been decoded, as read_records
+  yields them."""
+
+  # Characters that can't go into XML are dropped here, once, so nothing
+  # downstream has to check.
+  if HAS_INVALID_XML.search(record):
+    record = record.translate(INVALID_XML_TABLE)
 
   objekt = {}
-  fields = line.split("\t")
+  fields = record.split("\t")
+  has_word = HAS_WORD_CHARACTER.search
 
-  for i in range(len(COLUMNS)):
-    if re.match(r'.*\w.*', fields[i]):
-      objekt[COLUMNS[i]['name']] = fields[i]
-      if COLUMNS[i].has_key('repeat'):
-        break_out_multiple_objects(COLUMNS[i]['name'], objekt)
+  for i, name, repeat, cleaner in COLUMN_PLAN:
+    if has_word(fields[i]):
+      objekt[name] = cleaner(fields[i])
 
-  for field in objekt.keys():
-    trim_extra_spaces(field, objekt)
   agents = []
   agents = break_out_agents(objekt)
 
-  # Other fields may benefit from this as well, but it's a prime
-  # offender
-  #objekt['on_view_location'] = objekt['on_view_location'].replace("\n", "")
+  # Newlines inside fields are kept; read_records puts the records they
+  # split back together.
 
   return objekt, agents
 
-def just_space(field):
-  """Is the field only whitespace?"""
-  match = re.search(r'^\s*$', field)
-  if match is None:
-    return False
-  return True
-
 def break_out_multiple_objects(field, target): 
   """Given the name of a potentially repeating field, fix up that field
   appropriately"""
+  target[field] = split_repeats(target[field])
 
-  # Due to multiple possible delimeters in the export from FM, the
-  # object in question could already be a list. 
-  # Cannot assume that a given field will only have one type of delimiters.
-  for delimiter in ["", ""]:
-    if type(target[field]) != type([]):
-      target[field] = break_on_delimeter(target[field], delimiter)
-    else:
-      accumulator = []
-      for value in target[field]:
-        accumulator += break_on_delimeter(value, delimiter)
-      target[field] = accumulator
-
-  # Wrap single values in arrays so that code down the line isn't
-  # confused
-  if type(target[field]) != type([]):
-    target[field] = [ target[field] ]
-
-def break_on_delimeter(string, delimiter):
-  if string.find(delimiter) > -1:
-    all_values = string.split(delimiter)
-    return_values = []
-    for i in range(len(all_values)):
-      if not just_space(all_values[i]):
-        return_values.append(all_values[i])
-    if len(return_values) == 1:
-      return return_values[0]
-    else:
-      return return_values
-  else:
-    return [string]
+def split_repeats(value):
+  """Splits the value of a repeating field on either FileMaker repeat
+  character, in one pass. Pieces that are only whitespace (spurious
+  repeats) are dropped. Always returns a list."""
+  pieces = value.replace('\x1d', '\x0b').split('\x0b')
+  if len(pieces) == 1:
+    return pieces
+  return [piece for piece in pieces if piece.strip(WHITESPACE) != '']
 
 def trim_extra_spaces(field, target):
   if type(target[field]) != type("") and type(target[field]) != type(u''):
@@ -187,10 +225,72 @@ def looks_like_commas_between_names(namesstring):
     return True
 
 def strip_spaces(string):
-  string = re.sub(r'^\s*', '', string)
-  string = re.sub(r'\s*$', '', string)
-  return string
+  return string.strip(WHITESPACE)
+
+def clean_scalar(string):
+  """Cleans the value of a field that doesn't repeat."""
+  if u'\x0b' in string or u'\x1d' in string:
+    string = string.translate(REPEAT_MARKER_TABLE)
+  return strip_spaces(string)
+
+COLUMN_PLAN = compile_columns(COLUMNS)
   
+class LRUCache(object):
+  """A bounded map that forgets the least recently used key first, and
+  counts hits and misses. Safe to share between threads."""
+
+  def __init__(self, size):
+    self.size = size
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    """The value for key, or None."""
+    self.lock.acquire()
+    try:
+      value = self.entries.pop(key, None)
+      if value is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+        self.entries[key] = value
+      return value
+    finally:
+      self.lock.release()
+
+  def put(self, key, value):
+    self.lock.acquire()
+    try:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      if len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+    finally:
+      self.lock.release()
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses}
+
+# The same artists, authors and editors turn up on thousands of rows.
+UNPACKED_NAMES = LRUCache(NAME_CACHE_SIZE)
+GUESSED_NAMES = LRUCache(NAME_CACHE_SIZE)
+
+# Cache counts sent back by parse_chunk from worker processes
+worker_cache_stats = {}
+
+def name_cache_stats():
+  """Hit and miss counts for the name caches, including any from a
+  parallel parse's workers."""
+  stats = {}
+  for name, cache in [('unpack_agent_names', UNPACKED_NAMES),
+                      ('guess_name_order', GUESSED_NAMES)]:
+    for counter, value in cache.stats().items():
+      key = '%s_cache_%s' % (name, counter)
+      stats[key] = value + worker_cache_stats.get(key, 0)
+  return stats
+
 def unpack_agent_names(namestuff):
   """Given a string containing all the agent names, return a list of
     the names in whatever form they occur (inverted or not)"""
@@ -199,6 +299,13 @@ def unpack_agent_names(namestuff):
     # ironically, the creator_text_inverted never intentionally uses the
     #  divider
     namestuff = namestuff[0]
+  names = UNPACKED_NAMES.get(namestuff)
+  if names is None:
+    names = split_agent_names(namestuff)
+    UNPACKED_NAMES.put(namestuff, names)
+  return list(names)
+
+def split_agent_names(namestuff):
   if namestuff.find(';') >= 0:
     first, sep, rest = namestuff.partition(';')
     names = [first]
@@ -309,8 +416,16 @@ def break_out_agents(agentdict):
 
 def guess_name_order(namestring):
    """given a name, guess what part is first and which is last. return
-   hash with keys first_name, last_name"""
+   hash with keys first_name, last_name. The hash is the caller's to
+   change."""
 
+   names = GUESSED_NAMES.get(namestring)
+   if names is None:
+     names = parse_name_order(namestring)
+     GUESSED_NAMES.put(namestring, names)
+   return dict(names)
+
+def parse_name_order(namestring):
    names = {}
    if (namestring.find(',') > -1) and (namestring.find(',') < (len(namestring) - 1)):
      names['last_name'], names['first_name'] = namestring.split(',', 1)
@@ -343,16 +458,14 @@ def some_agent_names_from_string(string, delimiter):
     return some_agents
   return []
 
-def note_oddities(objekt):
+def find_oddities(objekt):
   """
-  TODO something smoother re: opening these files. And/or emptying them
-  out at first.
+  Returns a list of (category, object_id, value) rows for the parts of
+  a parsed record that need a human to look at them. Categories are the
+  keys of report.REPORT_CATEGORIES.
   """
-  RUNTIME = open('runtime.log', 'a')
-  FRAME = open('frame.log', 'a')
-  ETHNICITY = open('ethnicity.log', 'a')
-  AGENTS = open('agents.log', 'a')
-  EDITORS = open('editors.log', 'a')
+  oddities = []
+  object_id = objekt.get('object_id')
 
   weird_name = False
   for agent in objekt['agents']:
@@ -361,66 +474,296 @@ def note_oddities(objekt):
         weird_name = True
 
   #if weird_name:
-  #  AGENTS.write("for object %s, we parsed '%s' as:\n" % (objekt['object_id'], objekt['creator_text_inverted']))
-  #  for agent in objekt['agents']:
-  #    for field in ['first_name', 'middle_name', 'last_name']:
-  #      if agent.has_key(field):
-  #        AGENTS.write("  %s: %s\n" % (field, agent[field]))
-  #        if field == 'last_name':
-  #          AGENTS.write("\n")
-
-  if objekt.has_key('running_time') and type(objekt['running_time']) == type(''):
+  #  oddities.append(('agents', object_id, objekt['creator_text_inverted']))
+
+  if objekt.has_key('running_time') and isinstance(objekt['running_time'], basestring):
     if objekt['running_time'] != '' and objekt['running_time'].find('inute') < 0:
-      RUNTIME.write("%s: %s\n" % (objekt['object_id'], objekt['running_time']))
+      oddities.append(('runtime', object_id, objekt['running_time']))
 
   if objekt.has_key('ethnicity'):
     match = re.search(r'\d', objekt['ethnicity'])
     if match is not None:
-      ETHNICITY.write("%s: %s\n" % (objekt['object_id'], objekt['ethnicity']))
+      oddities.append(('ethnicity', object_id, objekt['ethnicity']))
 
   understood_frames = ['Artist Specified Framing', 'Yes', 'yes', 'No',
     'no', 'No Frame', 'Unique Frame', 'Frame', ['no', 'No Frame'],
     ['yes', 'Frame'], ['Yes', 'Frame'], ['No', 'No Frame'], ['N.A.',
     'No Frame'], ['Frame', 'Artist Specified Framing']]
   if objekt.has_key('frame') and not objekt['frame'] in understood_frames:
-    FRAME.write("%s: %s\n" % (objekt['object_id'], objekt['frame']))
+    oddities.append(('frame', object_id, objekt['frame']))
 
   if objekt.has_key('editor'):
     match = re.search(r'the undersigned', objekt['editor'])
     if match is not None:
-      EDITORS.write("%s: %s\n" % (objekt['object_id'], objekt['editor']))
+      oddities.append(('editors', object_id, objekt['editor']))
+
+  return oddities
+
+def note_oddities(objekt, report):
+  """Writes the oddities in a parsed record to a report.Report."""
+  for category, object_id, value in find_oddities(objekt):
+    report.note(category, object_id, value)
+
+def decoded_lines(filename, start=0, end=None, block_size=BLOCK_SIZE):
+  """Yields the lines of a mac-roman file, or of its bytes from start to
+  end, as unicode without their newlines. The file is memory-mapped and
+  decoded block_size bytes at a time; mac-roman is a byte per character,
+  so a block never ends part way through one."""
+  size = os.path.getsize(filename)
+  if end is None or end > size:
+    end = size
+  if start >= end:
+    return
+  handle = open(filename, 'rb')
+  data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    partial = u''
+    for offset in xrange(start, end, block_size):
+      block = data[offset:min(offset + block_size, end)].decode('mac-roman')
+      lines = (partial + block).split(u'\n')
+      partial = lines.pop()
+      for line in lines:
+        yield line
+    if partial != u'':
+      yield partial
+  finally:
+    data.close()
+    handle.close()
+
+def assemble_records(lines, on_bad=None):
+  """Joins lines back into records. A record is complete once it has a
+  field for every column, however many newlines its fields had in them.
+  Pieces that never get that far, because the next line would take them
+  past it or the input ends, go to on_bad, if given, instead of being
+  yielded. Blank lines between records are skipped."""
+  pending = []
+  tabs = 0
+  for line in lines:
+    line_tabs = line.count(u'\t')
+    if len(pending) > 0 and tabs + line_tabs > RECORD_TABS:
+      if on_bad is not None:
+        on_bad(u'\n'.join(pending))
+      pending = []
+      tabs = 0
+    if len(pending) == 0 and line_tabs == 0 and line.strip(WHITESPACE) == u'':
+      continue
+    pending.append(line)
+    tabs += line_tabs
+    if tabs >= RECORD_TABS:
+      yield u'\n'.join(pending)
+      pending = []
+      tabs = 0
+  if len(pending) > 0 and on_bad is not None:
+    on_bad(u'\n'.join(pending))
+
+def read_records(filename, on_bad=None, start=0, end=None, block_size=BLOCK_SIZE):
+  """Yields each record of a FileMaker export, decoded, as one string,
+  with any newlines embedded in its fields. See assemble_records for
+  on_bad."""
+  return assemble_records(decoded_lines(filename, start, end, block_size), on_bad)
+
+def chunk_offsets(filename, chunk_size=CHUNK_SIZE):
+  """Splits a file into (start, end) byte ranges of roughly chunk_size
+  bytes, each of which begins and ends on a record boundary. The file is
+  read through once, putting lines together the way assemble_records
+  does (tabs and newlines are the same bytes in mac-roman as once
+  decoded), and a range only ends where a record does."""
+  size = os.path.getsize(filename)
+  handle = open(filename, 'rb')
+  offsets = []
+  start = 0
+  end = 0
+  pending = False
+  tabs = 0
+  for line in handle:
+    end += len(line)
+    line_tabs = line.count('\t')
+    if pending and tabs + line_tabs > RECORD_TABS:
+      pending = False
+      tabs = 0
+    if not pending and line_tabs == 0 and line.strip(WHITESPACE) == '':
+      continue
+    pending = True
+    tabs += line_tabs
+    if tabs >= RECORD_TABS:
+      pending = False
+      tabs = 0
+      if end - start >= chunk_size:
+        offsets.append((start, end))
+        start = end
+  handle.close()
+  if start < size:
+    offsets.append((start, size))
+  return offsets
+
+def parse_chunk(chunk):
+  """Parses the records in one (filename, start, end) byte range. Runs
+  in a worker process. Returns the parsed records, the pieces that
+  weren't whole records, and the name cache counts for the chunk."""
+  filename, start, end = chunk
+  before = name_cache_stats()
+  bad = []
+  results = [parse_record(record) for record in
+    read_records(filename, bad.append, start, end)]
+  after = name_cache_stats()
+  stats = dict([(key, after[key] - before[key]) for key in after.keys()])
+  return results, bad, stats
+
+def parse_file(filename, workers=1, chunk_size=CHUNK_SIZE, on_bad=None):
+  """Yields (object, agents) for every record of a FileMaker export, in
+  file order. With more than one worker the file is parsed in chunks by
+  a process pool, at most CHUNKS_IN_FLIGHT per worker ahead of the
+  caller; the results are the same as a serial parse. Pieces of the
+  file that aren't whole records go to on_bad, if given."""
+  if workers <= 1:
+    for record in read_records(filename, on_bad):
+      yield parse_record(record)
+    return
+
+  chunks = [(filename, start, end) for start, end in chunk_offsets(filename, chunk_size)]
+  pool = Pool(workers)
+  try:
+    in_flight = deque()
+    for chunk in chunks[:CHUNKS_IN_FLIGHT * workers]:
+      in_flight.append(pool.apply_async(parse_chunk, (chunk,)))
+    submitted = len(in_flight)
+    while len(in_flight) > 0:
+      results, bad, stats = in_flight.popleft().get()
+      if submitted < len(chunks):
+        in_flight.append(pool.apply_async(parse_chunk, (chunks[submitted],)))
+        submitted += 1
+      for key, value in stats.items():
+        worker_cache_stats[key] = worker_cache_stats.get(key, 0) + value
+      if on_bad is not None:
+        for piece in bad:
+          on_bad(piece)
+      for result in results:
+        yield result
+  finally:
+    pool.terminate()
+    pool.join()
+
+class JsonLinesWriter(object):
+  """Writes parsed records one JSON document per line, flushing after
+  each so the file can be read (or tailed) while the parse is still
+  running."""
+
+  def __init__(self, filename):
+    self.output = codecs.open(filename, 'w', 'utf-8')
+
+  def write(self, objekt):
+    self.output.write(json.dumps(objekt, ensure_ascii=False))
+    self.output.write(u"\n")
+    self.output.flush()
+
+  def close(self):
+    self.output.close()
+
+class JsonArrayWriter(object):
+  """Writes parsed records as a single JSON array, the original output
+  format. Records are still written as they arrive rather than being
+  collected first."""
+
+  def __init__(self, filename):
+    self.output = codecs.open(filename, 'w', 'utf-8')
+    self.output.write(u"[")
+    self.count = 0
+
+  def write(self, objekt):
+    if self.count > 0:
+      self.output.write(u", ")
+    self.output.write(json.dumps(objekt, ensure_ascii=False))
+    self.count += 1
+
+  def close(self):
+    self.output.write(u"]")
+    self.output.close()
+
+OUTPUT_WRITERS = {
+  'jsonl': JsonLinesWriter,
+  'json': JsonArrayWriter,
+  'sqlite': new_staging_store,
+  }
+OUTPUT_FILES = {
+  'jsonl': WAC_OBJECTS_FILE,
+  'json': WAC_OBJECTS_FILE,
+  'sqlite': WAC_STAGING_FILE,
+  }
+
+def read_objects(filename):
+  """Yields the records in a file written by one of the OUTPUT_WRITERS.
+  JSON arrays have to be loaded whole; JSON lines are read one at a
+  time."""
+  jfile = codecs.open(filename, 'r', 'utf-8')
+  first = jfile.read(1)
+  while first != '' and first.isspace():
+    first = jfile.read(1)
+  if first == '[':
+    jfile.seek(0)
+    for objekt in json.load(jfile):
+      yield objekt
+  else:
+    jfile.seek(0)
+    for line in jfile:
+      if line.strip() != '':
+        yield json.loads(line)
+  jfile.close()
+
+def print_record(objekt, agents):
+  print "--------------------"
+  for row in COLUMNS:
+    field = row['name']
+    if objekt.has_key(field):
+      if type(objekt[field]) == type([]):
+        for datum in objekt[field]:
+          debug = "%s -- '%s'" % (field, datum)
+          print debug.encode('utf-8')
+      else:
+        debug = "%s -- '%s'" % (field, objekt[field])
+        print debug.encode('utf-8')
+  print "--------------------"
+  print "Agent details:"
+  for agent in agents:
+    for field in agent.keys():
+      debug = "%s -- '%s'" % (field, agent[field])
+      print debug.encode('utf-8')
 
 if __name__ == "__main__":
-  TABFILE = open('wacart.tab')
+  parser = OptionParser()
+  parser.add_option('-f', '--format', dest='format', default='jsonl',
+    choices=OUTPUT_WRITERS.keys(),
+    help="output format: jsonl (one record per line, written as parsed) "
+      "or json (a single array) in %s, or sqlite (a staging store) in %s "
+      "[default: %%default]" % (WAC_OBJECTS_FILE, WAC_STAGING_FILE))
+  parser.add_option('-j', '--workers', dest='workers', type='int', default=1,
+    help="number of processes to parse with [default: %default]")
+  (options, args) = parser.parse_args()
+
   BADLINES = open('badlines.log', 'w')
 
-  objects = []
-
-  for line in TABFILE:
-    objekt, agents = parse_line(line)
-    print "--------------------"
-    for row in COLUMNS:
-      field = row['name']
-      if objekt.has_key(field):
-        if type(objekt[field]) == type([]):
-          for datum in objekt[field]:
-            debug = "%s -- '%s'" % (field, datum)
-            print debug.encode('utf-8')
-        else:
-          debug = "%s -- '%s'" % (field, objekt[field])
-          print debug.encode('utf-8')
-    print "--------------------"
-    print "Agent details:"
-    for agent in agents:
-      for field in agent.keys():
-        debug = "%s -- '%s'" % (field, agent[field])
-        print debug.encode('utf-8')
-    objekt['agents'] = agents
-    objects.append(objekt)
-    note_oddities(objekt)
+  output = OUTPUT_WRITERS[options.format](OUTPUT_FILES[options.format])
+  report = Report()
+  metrics = Metrics('wacart')
 
-  TABFILE.close()
+  def note_bad_record(piece):
+    BADLINES.write(piece.encode('utf-8') + "\n")
+    metrics.count('bad_records')
+
+  for objekt, agents in metrics.timed('parse', parse_file('wacart.tab',
+      options.workers, on_bad=note_bad_record)):
+    print_record(objekt, agents)
+    objekt['agents'] = agents
+    output.write(objekt)
+    note_oddities(objekt, report)
+    metrics.advance()
 
-  output = codecs.open(WAC_OBJECTS_FILE, 'w', 'utf-8')
-  json.dump(objects, output, ensure_ascii=False)
   output.close()
+  BADLINES.close()
+  for counter, value in name_cache_stats().items():
+    metrics.count(counter, value)
+  print metrics.progress_line()
+  metrics.write_summary()
+  counts = report.close()
+  print "Data-quality report:"
+  for category in sorted(counts.keys()):
+    print "  %s: %s" % (category, counts[category])